@@ -1,14 +1,21 @@
+import copy
+import os
+import time
+from functools import partial
+
 import numpy as np
-from PyQt5 import QtWidgets, QtCore
+from PyQt5 import QtWidgets, QtCore, QtGui
 
 # Core utility and services
 from app.utils.clean_cache import remove_directories
 from app.utils.logging_manager import LoggingManager
 from app.services.image_service import ImageServices
+from app.services.job_service import JobService
+from app.services.cache_service import ResultCache, image_digest, source_version
 
 # Main GUI design
 from app.design.main_layout import Ui_MainWindow
-from app.processing.segmentation_clusters import kMeans_segmentation, agglomerative_segmentation
+from app.processing.segmentation_clusters import mini_batch_kMeans_segmentation, agglomerative_tree, region_graph_tree
 from app.processing.thresholding import Thresholding
 from app.processing.segmentation import ImageSegmenter
 # Image processing functionality
@@ -26,13 +33,43 @@ class MainWindowController:
 
         self.original_image = None
         self.processed_image = None
+        self.active_method = None   # which method produced processed_image (live slider previews follow it)
+        self.mean_shift_result = None   # labels / modes / counts of the last mean shift run
+
+        # Preview / commit : methods and sliders run on a display sized proxy of the loaded image (cached per load),
+        # the full resolution image is only processed by "Full Res" or when saving
+        self.proxy_image = None
+        self.proxy_scale = 1.0
+        self.processed_full_resolution = True   # processed_image was computed on original_image (not the proxy)
+        self.job_full_resolution = False
+        self.save_when_full_resolution = False
+        self.thresholding_method = None
+        self.image_digests = {}   # full_resolution -> content hash of the working image (result cache keys)
 
         self.ui = Ui_MainWindow()
         self.ui.setupUi(self.MainWindow)
         self.log = LoggingManager()
 
+        # Results by (image content, method, parameters, code version) : the same button or slider value is computed
+        # once, in memory (least recently used evicted) and on disk across restarts; hits / misses counted by self.log
+        processing_dir = os.path.join(os.path.dirname(__file__), "processing")
+        # next to main.py, whatever the working directory
+        cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Cache")
+        self.cache = ResultCache(memory_budget=512 << 20, cache_dir=cache_dir,
+                                 version=source_version(processing_dir, __file__), log=self.log)
+
         self.srv = ImageServices()
         self.segmenter = ImageSegmenter()
+        self.jobs = JobService()   # processing runs in the background, the newest job of the processed view wins
+        self.job_title = None
+
+        # Processed view rendering, at most max_fps images a second (progressive previews of the running job)
+        self.max_fps = 10
+        self.last_render = 0.0
+        self.pending_render = None
+        self.render_timer = QtCore.QTimer()
+        self.render_timer.setSingleShot(True)
+        self.render_timer.timeout.connect(self.render_pending)
 
         # Connect signals to slots
         self.setupConnections()
@@ -47,7 +84,8 @@ class MainWindowController:
         self.ui.quit_app_button.clicked.connect(self.closeApp)
         self.ui.upload_button.clicked.connect(self.drawImage)
 
-        self.ui.save_image_button.clicked.connect(lambda: self.srv.save_image(self.processed_image))
+        self.ui.save_image_button.clicked.connect(self.save_processed)
+        self.ui.full_resolution_button.clicked.connect(self.apply_full_resolution)
         self.ui.clear_image_button.clicked.connect(self.clear_images)
         self.ui.reset_image_button.clicked.connect(self.reset_images)
 
@@ -57,21 +95,32 @@ class MainWindowController:
         self.ui.optimal_button.clicked.connect(lambda: self.apply_thresholding(Thresholding.optimal_thresholding))
         self.ui.spectral_threshold_apply_button.clicked.connect(lambda: self.apply_thresholding(Thresholding.spectral_thresholding))
         self.ui.otsu_button.clicked.connect(lambda: self.apply_thresholding(Thresholding.otsu_thresholding))
+        self.ui.adaptive_threshold_button.clicked.connect(self.apply_adaptive_thresholding)
 
         # Segmentation connections
         self.ui.segmentation_button.clicked.connect(self.show_segmentation_controls)
         self.ui.seg_back_button.clicked.connect(self.show_main_buttons)
-        self.ui.apply_kMeans_clustering_button.clicked.connect(self.apply_k_mean_clustering)
-        self.ui.apply_agglomerative_clustering_button.clicked.connect(self.apply_agglomerative_clustering)
+        self.ui.apply_kMeans_clustering_button.clicked.connect(lambda: self.apply_k_mean_clustering())
+        self.ui.apply_agglomerative_clustering_button.clicked.connect(lambda: self.apply_agglomerative_clustering())
+        self.ui.region_merging_button.clicked.connect(lambda: self.apply_region_merging())
 
         # New segmentation methods
-        self.ui.region_growing_button.clicked.connect(self.apply_region_growing)
-        self.ui.mean_shift_button.clicked.connect(self.apply_mean_shift)
+        self.ui.region_growing_button.clicked.connect(lambda: self.apply_region_growing())
+        self.ui.mean_shift_button.clicked.connect(lambda: self.apply_mean_shift())
         self.ui.region_growing_tolerance_slider.valueChanged.connect(self.update_region_growing_tolerance)
+        self.ui.clusters_number_slider.valueChanged.connect(self.update_clusters_number)
+        self.ui.mean_shift_bandwidth_slider.valueChanged.connect(self.update_bandwidth_mean_shift)
+        self.ui.spatial_length_slider.valueChanged.connect(self.update_spatial_radius_mean_shift)
 
         # Mouse click for seed point
         self.ui.original_groupBox.mousePressEvent = self.get_seed_point
 
+        # Background jobs : progress in the status bar, busy cursor over the result, Esc cancels
+        self.jobs.progress.connect(self.show_job_progress)
+        self.jobs.busy_changed.connect(self.show_job_busy)
+        self.cancel_shortcut = QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_Escape), self.MainWindow)
+        self.cancel_shortcut.activated.connect(self.cancel_processing)
+
     def drawImage(self):
         self.path = self.srv.upload_image_file()
 
@@ -82,7 +131,18 @@ class MainWindowController:
         if self.original_image is None:
             return
 
+        self.jobs.cancel()   # results computed on the previous image are dropped
+        self.pending_render = None
+        self.save_when_full_resolution = False
         self.processed_image = self.original_image.copy()
+        self.processed_full_resolution = True
+        self.active_method = None
+        self.segmenter.clear_seed_points()   # seeds belong to the previous image
+        self.mean_shift_result = None
+        self.proxy_image, self.proxy_scale = self.srv.display_proxy(self.ui.processed_groupBox, self.original_image)
+        self.image_digests = {True: image_digest(self.original_image)}
+        self.image_digests[False] = (self.image_digests[True] if self.proxy_image is self.original_image
+                                     else image_digest(self.proxy_image))
 
         # Clear any existing images displayed in the group boxes
         self.srv.clear_image(self.ui.original_groupBox)
@@ -96,45 +156,103 @@ class MainWindowController:
         self.ui.original_groupBox.show()
         self.ui.processed_groupBox.show()
 
-    def apply_k_mean_clustering(self):
+    def working_image(self, full_resolution=False):
+        """The image a method runs on (the loaded image or its display proxy) and its scale to the loaded image."""
+        if full_resolution:
+            return self.original_image, 1.0
+        return self.proxy_image, self.proxy_scale
+
+    def apply_k_mean_clustering(self, full_resolution=False):
+        if self.original_image is None:
+            return
+
         k = self.ui.clusters_number_slider.value()
-        segmented_labels = kMeans_segmentation(self.original_image.copy(), k)
+        image, _ = self.working_image(full_resolution)
+        self.run_job("kmeans", "k-means clustering", self.k_means_job, image, k,
+                     params=(k,), full_resolution=full_resolution)
+
+    @staticmethod
+    def k_means_job(image, k, token=None):
+        if token is not None:
+            token.render = partial(MainWindowController.colorize_labels, k=k)   # previews are thumbnail labels
+        segmented_labels = mini_batch_kMeans_segmentation(image, k, token=token)   # full resolution labels
 
         # Colorize the segmentation
-        segmented_display = cv2.applyColorMap(
-            (segmented_labels * int(255 / (k - 1))).astype(np.uint8),
+        return MainWindowController.colorize_labels(segmented_labels, k)
+
+    @staticmethod
+    def colorize_labels(labels, k):
+        return cv2.applyColorMap(
+            (labels * int(255 / (k - 1))).astype(np.uint8),
             cv2.COLORMAP_JET
         )
 
-        self.processed_image = segmented_display
-        self.srv.clear_image(self.ui.processed_groupBox)
-        self.srv.set_image_in_groupbox(self.ui.processed_groupBox, self.processed_image)
+    def apply_agglomerative_clustering(self, full_resolution=False):
+        if self.original_image is None:
+            return
 
-    def apply_agglomerative_clustering(self):
         k = self.ui.clusters_number_slider.value()  # Get number of clusters from the slider
+        image, _ = self.working_image(full_resolution)
+        tree_key = self.cache.key(self.image_digests[full_resolution], "agglomerative_tree", ())
+        self.run_job("agglomerative", "Agglomerative clustering", self.agglomerative_job,
+                     image, tree_key, k, params=(k,), full_resolution=full_resolution)
 
-        segmented_labels = agglomerative_segmentation(self.original_image.copy(), k)
+    def agglomerative_job(self, image, tree_key, k, token=None):
+        # The merge tree is built once per image (on a resized copy) and cached on its own, not per k :
+        # any k is then a cut of it, every pixel of the image taking the cluster of the closest mean colour
+        tree = self.cache.compute(tree_key, agglomerative_tree, image, token=token)
+        segmented_labels = tree.label_image(image, k, token=token)
 
         # Colorize the segmentation result for display
-        segmented_display = cv2.applyColorMap(
-            (segmented_labels * int(255 / (k - 1))).astype(np.uint8),
-            cv2.COLORMAP_JET
-        )
+        return self.colorize_labels(segmented_labels, k)
 
-        self.processed_image = segmented_display
-        self.srv.clear_image(self.ui.processed_groupBox)
-        self.srv.set_image_in_groupbox(self.ui.processed_groupBox, self.processed_image)
+    def apply_region_merging(self, full_resolution=False):
+        """Spatially constrained agglomerative clustering : adjacent regions of a grid over-segmentation are merged."""
+        if self.original_image is None:
+            return
 
+        k = self.ui.clusters_number_slider.value()
+        image, _ = self.working_image(full_resolution)
+        # 8 pixel cells, larger on big images so the region graph stays below max_cells regions
+        max_cells = 32768
+        cell_size = max(8, int(np.ceil(np.sqrt(image.shape[0] * image.shape[1] / max_cells))))
+        tree_key = self.cache.key(self.image_digests[full_resolution], "region_graph_tree", (cell_size,))
+        self.run_job("region_merging", "Region merging", self.region_merging_job,
+                     image, tree_key, k, cell_size, params=(k, cell_size), full_resolution=full_resolution)
+
+    def region_merging_job(self, image, tree_key, k, cell_size, token=None):
+        # The region graph tree is built once per image and cached on its own, not per k :
+        # any k is then a cut of it (of the image size)
+        tree = self.cache.compute(tree_key, region_graph_tree, image, cell_size, token=token)
+        return self.colorize_labels(tree.cut(k), k)
 
     def update_region_growing_tolerance(self):
-        """Update tolerance value from slider."""
+        """Update tolerance value from slider, refreshing the region growing result live if it is shown."""
         self.segmenter.set_tolerance(self.ui.region_growing_tolerance_slider.value())
+        if self.active_method == "region_growing":
+            self.apply_region_growing()
+
+    def update_clusters_number(self):
+        """
+         Refresh the shown clustering live : the agglomerative and region merging results are new cuts of the cached
+         merge trees (no clustering again), k-means runs again on the proxy.
+        """
+        if self.active_method == "agglomerative":
+            self.apply_agglomerative_clustering()
+        elif self.active_method == "region_merging":
+            self.apply_region_merging()
+        elif self.active_method == "kmeans":
+            self.apply_k_mean_clustering()
 
     def update_bandwidth_mean_shift(self):
         self.segmenter.set_bandwidth(self.ui.mean_shift_bandwidth_slider.value())
+        if self.active_method == "mean_shift":
+            self.apply_mean_shift()
 
     def update_spatial_radius_mean_shift(self):
         self.segmenter.set_spatial_radius(self.ui.spatial_length_slider.value())
+        if self.active_method == "mean_shift":
+            self.apply_mean_shift()
 
     def get_seed_point(self, event):
         """Handle mouse click to set seed point for region growing."""
@@ -158,53 +276,187 @@ class MainWindowController:
         x = max(0, min(x, self.original_image.shape[1] - 1))
         y = max(0, min(y, self.original_image.shape[0] - 1))
 
-        self.segmenter.set_seed_point((y, x))
-        print(f"Seed point set to: {(y, x)}")
+        # Shift + click adds another seed (multi-seed region growing), a plain click starts over with one seed
+        if event.modifiers() & QtCore.Qt.ShiftModifier:
+            self.segmenter.add_seed_point((y, x))
+            print(f"Seed point added: {(y, x)} ({len(self.segmenter.seed_points)} seeds)")
+        else:
+            self.segmenter.set_seed_point((y, x))
+            print(f"Seed point set to: {(y, x)}")
 
-    def apply_region_growing(self):
+    def apply_region_growing(self, full_resolution=False):
         """Apply region growing segmentation."""
         if self.original_image is None:
             return
 
-        try:
-            segmented = self.segmenter.region_growing(self.original_image)
-            self.processed_image = cv2.cvtColor(segmented, cv2.COLOR_GRAY2BGR)
-            self.showProcessed()
-        except ValueError as e:
-            print(str(e))
-            QtWidgets.QMessageBox.warning(self.MainWindow, "Error", str(e))
-
-    def apply_mean_shift(self):
+        # parameters taken now : the GUI may change the segmenter's while the job waits or runs
+        image, scale = self.working_image(full_resolution)
+        params = (tuple(self.segmenter.seed_points), self.segmenter.tolerance, self.segmenter.collision_policy,
+                  self.ui.region_growing_tolerance_slider.maximum())
+        self.run_job("region_growing", "Region growing", self.region_growing_job, image, scale, *params,
+                     params=params, full_resolution=full_resolution)
+
+    def region_growing_job(self, image, scale, seed_points, tolerance, policy, max_tolerance, token=None):
+        # seeds are clicked in loaded image coordinates
+        seeds = [(min(int(y * scale), image.shape[0] - 1), min(int(x * scale), image.shape[1] - 1))
+                 for y, x in seed_points]
+        if len(seeds) > 1:
+            labels = self.segmenter.region_growing_multi(image, seeds, policy, token=token, tolerance=tolerance)
+
+            # Colorize one label per seed (a random colour each, as distinct for hundreds of seeds as for two),
+            # background stays black
+            colours = np.random.default_rng(0).integers(64, 256, (len(seeds) + 1, 3), dtype=np.uint8)
+            colours[0] = 0
+            return colours[labels]
+
+        # one-time per seed : afterwards every tolerance of the slider is a threshold of the distance map
+        seed = seeds[0] if seeds else None
+        self.segmenter.tolerance_distance_map(image, seed, max_tolerance=max_tolerance, token=token)
+        segmented = self.segmenter.region_growing(image, seed, tolerance)
+        return cv2.cvtColor(segmented, cv2.COLOR_GRAY2BGR)
+
+    def apply_mean_shift(self, full_resolution=False):
         """Apply mean shift segmentation."""
         if self.original_image is None:
             return
 
-        # Show busy cursor during processing
-        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-        try:
-            self.processed_image = self.segmenter.mean_shift(self.original_image)
-            self.showProcessed()
-        except Exception as e:
-            print(str(e))
-            QtWidgets.QMessageBox.warning(self.MainWindow, "Error", str(e))
-        finally:
-            QtWidgets.QApplication.restoreOverrideCursor()
+        # the job runs on a snapshot of the settings : the sliders may change the segmenter's while it waits or runs
+        image, scale = self.working_image(full_resolution)
+        segmenter = copy.copy(self.segmenter)
+        settings = segmenter.mean_shift_settings()   # None : not reproducible, never cached
+        self.run_job("mean_shift", "Mean shift", self.mean_shift_job, segmenter, image, scale,
+                     params=None if settings is None else settings + (scale,),
+                     full_resolution=full_resolution, on_result=self.show_mean_shift)
+
+    @staticmethod
+    def mean_shift_job(segmenter, image, scale, token=None):
+        # spatial parameters are meant for the loaded image, the segmenter scales them for a proxy
+        result = segmenter.mean_shift_segments(image, token=token, image_scale=scale)
+        return result, result.image
+
+    def show_mean_shift(self, result):
+        self.mean_shift_result, segmented_display = result
+        self.log.log_action(f"Mean shift computed in {self.mean_shift_result.elapsed:.4f} seconds "
+                            f"({len(self.mean_shift_result.modes)} segments, "
+                            f"{self.mean_shift_result.short_circuited} of {self.mean_shift_result.trajectories} "
+                            f"trajectories short-circuited)")
+        self.show_result("mean_shift", segmented_display)
+
+    def apply_thresholding(self, thresholding_method, mode="Global", block_size=30, full_resolution=False):
+        if self.original_image is None:
+            return
 
-    def apply_thresholding(self, thresholding_method, mode="Global", block_size=30):
         # ensure image is grayscale
-        gray_image=cv2.cvtColor(self.original_image, cv2.COLOR_BGR2GRAY)
-        # extract parameters
+        image, scale = self.working_image(full_resolution)
+        gray_image=cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # extract parameters (the block size is in loaded image pixels)
         mode = self.ui.threshold_type_combo.currentText()
-        block_size=self.ui.block_size_slider.value()
-
+        block_size=max(2, int(round(self.ui.block_size_slider.value() * scale)))
+        # window methods ("mean", "niblack", "sauvola") are local whatever the mode, the others are functions
+        adaptive = thresholding_method in Thresholding.ADAPTIVE_METHODS
+        mode = "Local" if adaptive else mode
+        name = thresholding_method if adaptive else thresholding_method.__qualname__
+
+        self.thresholding_method = thresholding_method
+        self.run_job("thresholding", "Thresholding", self.thresholding_job, gray_image, thresholding_method, mode,
+                     block_size, params=(name, mode, block_size), full_resolution=full_resolution)
+
+    def apply_adaptive_thresholding(self):
+        """Local mean / Niblack / Sauvola thresholding (adaptive method combo) over windows of the block size."""
+        self.apply_thresholding(Thresholding.ADAPTIVE_METHODS[self.ui.adaptive_method_combo.currentIndex()])
+
+    @staticmethod
+    def thresholding_job(gray_image, thresholding_method, mode, block_size, token=None):
         # call the appropriate function based on mode
-        if mode=="Global":
-            self.processed_image=thresholding_method(gray_image)
-        elif mode=="Local":
-            self.processed_image=Thresholding.local_thresholding(gray_image, thresholding_method, block_size)
+        if mode=="Local":
+            return Thresholding.local_thresholding(gray_image, thresholding_method, block_size)
+        return thresholding_method(gray_image)
+
+    def run_job(self, method, title, function, *args, params=None, full_resolution=False, on_result=None):
+        """
+         Runs function(*args, token=...) in the background for the processed view : the GUI stays responsive,
+         a newer job (another method, a slider move) cancels this one and a stale result is never shown.
+         The result goes to on_result, or is displayed as the processed image of method.
+         Intermediate results of the job are displayed as they come (see showProcessed).
+         params : everything besides the working image the result depends on, the result is then looked up in /
+                  stored to the result cache (None : always computed).
+         full_resolution : the job runs on the loaded image instead of its proxy (a commit, not a preview).
+        """
+        self.job_title = title
+        self.job_full_resolution = full_resolution
+        if not full_resolution:
+            self.save_when_full_resolution = False   # a new preview replaces the result that was to be saved
+        on_result = on_result or partial(self.show_result, method)
+
+        if params is not None:
+            key = self.cache.key(self.image_digests[full_resolution], method, params)
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.jobs.cancel("processed")   # superseded like by any newer job
+                on_result(cached)
+                return
+            function = partial(self.cache.compute, key, function)   # disk tier read / result stored by the job
+
+        self.ui.statusbar.showMessage(f"{title}... (Esc to cancel)")
+        self.jobs.submit("processed", function, *args,
+                         on_result=on_result, on_error=self.show_job_error, on_preview=self.showProcessed)
+
+    def show_result(self, method, image):
+        self.processed_image = image
+        self.processed_full_resolution = self.job_full_resolution
+        self.active_method = method
+        self.showProcessed()
+        suffix = "" if self.job_full_resolution else " (preview)"
+        self.ui.statusbar.showMessage(f"{self.job_title} done{suffix}", 3000)
+
+        if self.save_when_full_resolution and self.processed_full_resolution:
+            self.save_when_full_resolution = False
+            self.srv.save_image(self.processed_image)
+
+    def apply_full_resolution(self):
+        """Recomputes the shown result (a preview on the proxy) on the full resolution image, True if started."""
+        if self.original_image is None or self.active_method is None or self.processed_full_resolution:
+            return False
+
+        apply = {
+            "kmeans": self.apply_k_mean_clustering,
+            "agglomerative": self.apply_agglomerative_clustering,
+            "region_merging": self.apply_region_merging,
+            "region_growing": self.apply_region_growing,
+            "mean_shift": self.apply_mean_shift,
+            "thresholding": partial(self.apply_thresholding, self.thresholding_method),
+        }[self.active_method]
+        apply(full_resolution=True)
+        return True
+
+    def save_processed(self):
+        """Saves the processed image at full resolution, computing it first when only the preview exists."""
+        # armed first : a cached full resolution result is shown (and saved) before apply_full_resolution returns
+        self.save_when_full_resolution = True
+        if self.apply_full_resolution():
+            return
+        self.save_when_full_resolution = False
+        self.srv.save_image(self.processed_image)
 
-        self.srv.clear_image(self.ui.processed_groupBox)
-        self.srv.set_image_in_groupbox(self.ui.processed_groupBox, self.processed_image)
+    def show_job_progress(self, view, fraction):
+        self.ui.statusbar.showMessage(f"{self.job_title}... {int(fraction * 100)}% (Esc to cancel)")
+
+    def show_job_busy(self, view, busy):
+        if busy:
+            self.ui.processed_groupBox.setCursor(QtCore.Qt.BusyCursor)
+        else:
+            self.ui.processed_groupBox.unsetCursor()
+
+    def show_job_error(self, message):
+        print(message)
+        self.ui.statusbar.clearMessage()
+        QtWidgets.QMessageBox.warning(self.MainWindow, "Error", message)
+
+    def cancel_processing(self):
+        if self.jobs.is_busy("processed"):
+            self.jobs.cancel("processed")
+            self.save_when_full_resolution = False
+            self.ui.statusbar.showMessage(f"{self.job_title} cancelled", 3000)
 
     def apply_spectral_thresholding(self):
         segmented_image = Thresholding.spectral_thresholding(self.original_image.copy())
@@ -224,17 +476,40 @@ class MainWindowController:
         if self.original_image is None:
             return
 
+        self.jobs.cancel("processed")
+        self.pending_render = None
+        self.save_when_full_resolution = False
         self.processed_image = self.original_image.copy()
+        self.processed_full_resolution = True
+        self.active_method = None
         self.srv.clear_image(self.ui.processed_groupBox)
         self.srv.set_image_in_groupbox(self.ui.processed_groupBox, self.original_image)
 
-    def showProcessed(self):
-        if self.processed_image is None:
+    def showProcessed(self, image=None):
+        """
+         Displays image (an intermediate result of the running job) or else the processed image,
+         at most max_fps times a second : a call arriving sooner is deferred and only the newest image is drawn.
+        """
+        image = self.processed_image if image is None else image
+        if image is None:
             print("Error: Processed image is None.")
             return
 
-        self.srv.clear_image(self.ui.processed_groupBox)
-        self.srv.set_image_in_groupbox(self.ui.processed_groupBox, self.processed_image)
+        self.pending_render = image
+        wait = self.last_render + 1 / self.max_fps - time.perf_counter()
+        if wait > 0:
+            if not self.render_timer.isActive():
+                self.render_timer.start(int(wait * 1000) + 1)
+            return
+        self.render_pending()
+
+    def render_pending(self):
+        image, self.pending_render = self.pending_render, None
+        if image is None:
+            return
+
+        self.last_render = time.perf_counter()
+        self.srv.set_image_in_groupbox(self.ui.processed_groupBox, image)   # same view, pixmap updated in place
 
     # Thresholding methods
     def show_thresholding_controls(self):
@@ -246,6 +521,8 @@ class MainWindowController:
 
     def closeApp(self):
         """Close the application."""
+        self.jobs.cancel()
+        self.cache.close()
         remove_directories()
         self.app.quit()
 
@@ -197,9 +197,10 @@ class Ui_MainWindow(object):
         self.title_layout.addLayout(title_layout)
 
     def setupNavbar(self):
-        """Creates the Upload, Reset, Save, and Quit buttons."""
+        """Creates the Upload, Reset, Full Res, Save, and Quit buttons."""
         self.upload_button = self.util.createButton("📁 Upload Image", self.button_style)
         self.reset_image_button = self.util.createButton("🔄 Reset", self.button_style)
+        self.full_resolution_button = self.util.createButton("🔍 Full Res", self.button_style)
         self.save_image_button = self.util.createButton("💾 Save", self.button_style)
         self.clear_image_button = self.util.createButton("🗑️ Clear", self.button_style)
 
@@ -210,6 +211,7 @@ class Ui_MainWindow(object):
         self.navbar_layout.setSpacing(15)
         self.navbar_layout.addWidget(self.upload_button)
         self.navbar_layout.addWidget(self.reset_image_button)
+        self.navbar_layout.addWidget(self.full_resolution_button)
         self.navbar_layout.addWidget(self.save_image_button)
         self.navbar_layout.addWidget(self.clear_image_button)
         self.navbar_layout.addWidget(self.quit_app_button)
@@ -371,6 +373,12 @@ class Ui_MainWindow(object):
         self.optimal_button = self.util.createButton("Optimal Thresholding", self.button_style)
         self.spectral_threshold_apply_button = self.util.createButton("Spectral Thresholding", self.button_style)
 
+        # Window based (adaptive) local thresholding, always local : a threshold per pixel from the block around it
+        self.adaptive_method_combo = QtWidgets.QComboBox()
+        self.adaptive_method_combo.addItems(["Local Mean", "Niblack", "Sauvola"])
+        self.adaptive_method_combo.setStyleSheet(self.threshold_type_combo.styleSheet())
+        self.adaptive_threshold_button = self.util.createButton("Adaptive Thresholding", self.button_style)
+
         # Add widgets to layout
         self.page_thresholding_layout.addWidget(self.thresholding_back_button)
         self.page_thresholding_layout.addWidget(self.util.createSeparator())
@@ -381,6 +389,9 @@ class Ui_MainWindow(object):
         self.page_thresholding_layout.addWidget(self.optimal_button)
         self.page_thresholding_layout.addWidget(self.spectral_threshold_apply_button)
         self.page_thresholding_layout.addWidget(self.util.createSeparator())
+        self.page_thresholding_layout.addWidget(self.adaptive_method_combo)
+        self.page_thresholding_layout.addWidget(self.adaptive_threshold_button)
+        self.page_thresholding_layout.addWidget(self.util.createSeparator())
 
         # Create and add sliders
         self.block_size_slider = QtWidgets.QSlider(QtCore.Qt.Horizontal)
@@ -429,6 +440,7 @@ class Ui_MainWindow(object):
         self.region_growing_button = self.util.createButton("Region Growing", self.button_style)
         self.mean_shift_button = self.util.createButton("Mean Shift", self.button_style)
         self.apply_agglomerative_clustering_button = self.util.createButton("Agglomerative", self.button_style)
+        self.region_merging_button = self.util.createButton("Region Merging", self.button_style)
 
         # Create value display labels for sliders
         self.kmeans_clusters_value = self.util.createLabel("3", "color: #e94560; font-weight: bold;")
@@ -482,6 +494,7 @@ class Ui_MainWindow(object):
         self.page_segmentation_layout.addWidget(self.clusters_number_slider)
         self.page_segmentation_layout.addWidget(self.apply_kMeans_clustering_button)
         self.page_segmentation_layout.addWidget(self.apply_agglomerative_clustering_button)
+        self.page_segmentation_layout.addWidget(self.region_merging_button)
         self.page_segmentation_layout.addWidget(self.util.createSeparator())
 
 
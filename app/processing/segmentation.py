@@ -1,23 +1,86 @@
 import time
+from collections import deque, OrderedDict
 
 import numpy as np
 import cv2
-from collections import deque
+
+from app.utils.cancellation import checkpoint
+
+
+def _luv_to_bgr(colors):
+    """BGR uint8 colours of LUV float colours (8 bit LUV scale), any shape ending with 3 channels."""
+    bgr = np.clip(np.rint(colors), 0, 255).astype(np.uint8).reshape(-1, 1, 3)
+    return cv2.cvtColor(bgr, cv2.COLOR_LUV2BGR).reshape(np.shape(colors))
+
+
+class MeanShiftResult:
+    """
+     Mean shift segmentation of an image :
+     labels  : int32 map (image size) of the segment of every pixel
+     modes   : float32 (segments x 5) table of the mode of every segment : L, U, V, y, x (image coordinates)
+     counts  : pixels per segment
+     elapsed : seconds spent
+     trajectories    : mean shift trajectories run (of the base level for the pyramid) ...
+     short_circuited : ... and how many of them stopped in the basin of an already visited mode
+    """
+    def __init__(self, labels, modes, counts, elapsed, trajectories=0, short_circuited=0):
+        self.labels = labels
+        self.modes = modes
+        self.counts = counts
+        self.elapsed = elapsed
+        self.trajectories = trajectories
+        self.short_circuited = short_circuited
+
+    @property
+    def image(self):
+        """BGR view : every pixel coloured with its segment's mode."""
+        return _luv_to_bgr(self.modes[:, :3])[self.labels]
+
 
 class ImageSegmenter:
     def __init__(self):
         # Region Growing
         self.seed_point = None
+        self.seed_points = []   # Multi-seed region growing : one label per seed (in click order)
         self.tolerance = 20
+        self.collision_policy = "first_come"   # "first_come" or "closest" (see region_growing_multi)
+        self._region_cache = OrderedDict()   # (image id, seed) -> region growing state, least recently used first
+        self.region_cache_size = 4
 
         # Mean shift parameters
         self.bandwidth = 30
         self.spatial_radius = 15
         self.max_iterations = 10
+        self.mean_shift_engine = "grid"   # "grid" (binned, local windows) or "pixel" (reference loop over the entire image)
+        self.mean_shift_scale = 0.5        # working resolution, spatial_radius is in pixels at this scale
+        # Coarse to fine : modes found at pyramid_base_scale, boundaries refined up to mean_shift_target_scale
+        # (or until mean_shift_time_budget seconds are spent)
+        self.mean_shift_pyramid = False
+        self.pyramid_base_scale = 0.125
+        self.mean_shift_target_scale = 1.0
+        self.mean_shift_time_budget = None
+        self.mean_shift_mode_sharing = True   # stop trajectories entering the basin of an already visited mode ("grid" engine)
+        self.basin_fraction = 6               # basin radius : spatial_radius / basin_fraction, bandwidth / basin_fraction
+        self.mean_shift_trajectories = 0      # trajectories in the last run ...
+        self.short_circuited_trajectories = 0  # ... and how many of them stopped in a known basin
 
     # Set Region Growing Parameters
     def set_seed_point(self, point):
         self.seed_point = point
+        self.seed_points = [point]
+
+    def add_seed_point(self, point):
+        self.seed_point = point
+        self.seed_points.append(point)
+
+    def clear_seed_points(self):
+        self.seed_point = None
+        self.seed_points = []
+
+    def set_collision_policy(self, policy):
+        if policy not in ("first_come", "closest"):
+            raise ValueError(f"Unknown collision policy: {policy}")
+        self.collision_policy = policy
 
     def set_tolerance(self, tolerance):
         # max. allowed intensity difference for region growing , increasing tolerance -> taking larger area (more growing)
@@ -30,8 +93,162 @@ class ImageSegmenter:
     def set_spatial_radius(self, radius):
         self.spatial_radius = radius   # Controls how far to search for similar pixels
 
-    def region_growing(self, image):
+    def set_mean_shift_pyramid(self, enabled, target_scale=1.0, time_budget=None):
+        # Coarse to fine mean shift, refined up to target_scale (1 = full resolution) or until time_budget seconds
+        self.mean_shift_pyramid = enabled
+        self.mean_shift_target_scale = target_scale
+        self.mean_shift_time_budget = time_budget
+
+    def mean_shift_settings(self):
+        """Every parameter a mean shift result depends on (e.g. for a result cache key), None if it depends on timing."""
+        if self.mean_shift_pyramid and self.mean_shift_time_budget is not None:
+            return None
+        return (self.bandwidth, self.spatial_radius, self.max_iterations, self.mean_shift_engine, self.mean_shift_scale,
+                self.mean_shift_pyramid, self.pyramid_base_scale, self.mean_shift_target_scale,
+                self.mean_shift_mode_sharing, self.basin_fraction)
+
+    def region_growing(self, image, seed_point=None, tolerance=None):
+        """
+         Scanline flood fill over the tolerance mask (same result as region_growing_bfs, in C speed).
+         Fills are cached per (image, seed) as the tolerance at which every pixel joins the region,
+         so moving the tolerance slider back to an already seen range is a single threshold of that map
+         (and any tolerance once tolerance_distance_map was computed).
+         seed_point : (y, x) in image, the segmenter's seed point by default.
+         tolerance  : the segmenter's tolerance by default.
+         Retruns : Segmented image as binary mask (0 = background, 255 = segmented region).
+        """
+        seed_point = self.seed_point if seed_point is None else seed_point
+        if seed_point is None:
+            raise ValueError("Seed point not set")
+
+        state = self._region_growing_state(image, seed_point)
+        tolerance = min(self.tolerance if tolerance is None else tolerance, 255)   # every |pixel - seed| is <= 255
+        if not any(level <= tolerance <= covered for level, covered in state["covered"].items()):
+            self._fill_region(state, tolerance)
+
+        # 255 where the pixel joined at a tolerance <= the current one, in one pass
+        return cv2.compare(state["join_level"], float(tolerance), cv2.CMP_LE)
+
+    def tolerance_distance_map(self, image, seed_point=None, max_tolerance=255, token=None):
+        """
+         Minimax distance from the seed : the smallest tolerance at which each pixel joins the region
+         (= the largest |pixel - seed| along the best 8-connected path from the seed to it).
+         Computed once per (image, seed) with one flood fill per tolerance level, ascending, where levels that can not
+         change the region are skipped : once a fill adds no pixel, the lowest |pixel - seed| on the region's frontier
+         is the next level at which it grows, and a fill covering the whole image ends the loop.
+         Then region growing at any tolerance T <= max_tolerance is just distance <= T.
+         Retruns : uint8 map (255 = joins only above max_tolerance).
+        """
+        seed_point = self.seed_point if seed_point is None else seed_point
+        if seed_point is None:
+            raise ValueError("Seed point not set")
+
+        state = self._region_growing_state(image, seed_point)
+        max_tolerance = min(int(max_tolerance), 255)
+
+        level, last_area = 0, None
+        while level <= max_tolerance:
+            checkpoint(token, level / (max_tolerance + 1))
+            covered = [up_to for filled, up_to in state["covered"].items() if filled <= level <= up_to]
+            if not covered:
+                area = self._fill_region(state, level, find_frontier=False)
+                if area == last_area and state["covered"][level] < 255:
+                    # the region stopped growing : skip the levels up to its frontier
+                    state["covered"][level] = self._frontier_level(state) - 1
+                last_area = area
+                covered = [state["covered"][level]]
+            level = max(covered) + 1
+
+        distance = state["join_level"].copy()
+        distance[distance > max_tolerance] = 255   # above max_tolerance only fills done by region_growing were recorded
+        return distance
+
+    def _region_growing_state(self, image, seed_point=None):
+        """Returns the cached region growing state for (image, seed point), starting a new one on a miss."""
+        seed_point = self.seed_point if seed_point is None else seed_point
+        key = (id(image), tuple(seed_point))
+        state = self._region_cache.get(key)
+        # the state keeps a reference to its image, so the id can not be reused while it is cached
+        if state is not None and state["image"] is image:
+            self._region_cache.move_to_end(key)
+            return state
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) > 2 else image
+        height, width = gray.shape
+        y, x = seed_point
+
+        state = {
+            "image": image,
+            "seed": seed_point,
+            "gray": gray,
+            # lowest filled tolerance at which each pixel is in the region (255 = not yet, every pixel is in at 255)
+            "join_level": np.full((height, width), 255, dtype=np.uint8),
+            # floodFill needs a mask 2 pixels larger than the image, reused between fills
+            "mask": np.zeros((height + 2, width + 2), dtype=np.uint8),
+            "rect": (x, y, 1, 1),   # bounding box of the last fill (the only part of the mask to clear)
+            # filled tolerance -> highest tolerance giving the same region (just below the lowest |pixel - seed| on its frontier)
+            "covered": {255: 255},
+        }
+        self._region_cache[key] = state
+        while len(self._region_cache) > self.region_cache_size:
+            self._region_cache.popitem(last=False)
+        return state
+
+    @staticmethod
+    def _fill_region(state, tolerance, find_frontier=True):
         """
+         Flood fills the cached image at tolerance (< 255) and records its join levels (and frontier).
+         Retruns : the number of pixels in the region.
+        """
+        gray, mask, join_level = state["gray"], state["mask"], state["join_level"]
+        y, x = state["seed"]
+        tolerance = int(tolerance)
+
+        rx, ry, rw, rh = state["rect"]
+        mask[ry + 1:ry + rh + 1, rx + 1:rx + rw + 1] = 0
+
+        # FIXED_RANGE : every pixel is compared against the seed intensity (not against its neighbour),
+        # so |pixel - seed| <= tolerance exactly like the BFS. 8 -> 8-connected neighbours.
+        # The region is marked 255 - tolerance in the mask, so that its complement is the join level.
+        flags = 8 | cv2.FLOODFILL_FIXED_RANGE | cv2.FLOODFILL_MASK_ONLY | ((255 - tolerance) << 8)
+        area, _, _, rect = cv2.floodFill(gray, mask, (int(x), int(y)), 0, tolerance, tolerance, flags)
+        rx, ry, rw, rh = state["rect"] = rect
+
+        # join_level = min(join_level, tolerance) inside the region : ~region is tolerance inside / 255 outside
+        region = mask[ry + 1:ry + rh + 1, rx + 1:rx + rw + 1]
+        joined = join_level[ry:ry + rh, rx:rx + rw]
+        cv2.min(joined, cv2.bitwise_not(region), dst=joined)
+
+        if area == gray.size:
+            state["covered"][tolerance] = 255   # the region covers the whole image
+        elif find_frontier:
+            state["covered"][tolerance] = ImageSegmenter._frontier_level(state) - 1
+        else:
+            state["covered"][tolerance] = tolerance
+        return area
+
+    @staticmethod
+    def _frontier_level(state):
+        """
+         Lowest |pixel - seed| on the frontier of the last fill (pixels touching the region without being in it) :
+         the region only grows again once the tolerance reaches it. The fill must not cover the whole image.
+        """
+        gray, mask = state["gray"], state["mask"]
+        height, width = gray.shape
+        y, x = state["seed"]
+        rx, ry, rw, rh = state["rect"]
+
+        # inside the box + 1 pixel ring, in C passes (about the cost of a fill)
+        y0, y1 = max(ry - 1, 0), min(ry + rh + 1, height)
+        x0, x1 = max(rx - 1, 0), min(rx + rw + 1, width)
+        ring = mask[y0 + 1:y1 + 1, x0 + 1:x1 + 1]
+        frontier = cv2.bitwise_and(cv2.dilate(ring, np.ones((3, 3), np.uint8)), cv2.compare(ring, 0, cv2.CMP_EQ))
+        distance = cv2.absdiff(gray[y0:y1, x0:x1], np.full((y1 - y0, x1 - x0), gray[y, x], dtype=np.uint8))
+        return int(cv2.minMaxLoc(distance, mask=frontier)[0])
+
+    def region_growing_bfs(self, image):
+        """
+         Reference (pixel-by-pixel BFS) implementation of region growing, kept to check the fast engine against.
          Retruns : Segmented image as binary mask (0 = background, 255 = segmented region).
         """
         if self.seed_point is None:
@@ -71,23 +288,466 @@ class ImageSegmenter:
 
         return segmented
 
-    def mean_shift(self, image):
-        """Mean shift segmentation using sliding window """
+    def region_growing_multi(self, image, seed_points=None, policy=None, token=None, tolerance=None):
+        """
+         Grows all seeds together over one shared label buffer (a pixel belongs to at most one region).
+         Each region keeps the usual rule : |pixel - its own seed intensity| <= tolerance, 8-connected.
+
+         policy decides who gets a pixel that two regions can both reach:
+           "first_come" : the region whose wavefront reaches it first (ties -> lower seed index).
+           "closest"    : the region whose seed intensity is closest (regions grow in order of intensity difference).
+
+         seed_points / policy / tolerance default to the segmenter's.
+         Retruns : int32 label image (0 = background, i + 1 = region grown from seed_points[i]).
+        """
+        seed_points = self.seed_points if seed_points is None else seed_points
+        policy = self.collision_policy if policy is None else policy
+        tolerance = self.tolerance if tolerance is None else tolerance
+        if not seed_points:
+            raise ValueError("Seed point not set")
+        if policy not in ("first_come", "closest"):
+            raise ValueError(f"Unknown collision policy: {policy}")
+
+        if len(image.shape) > 2:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) # convert from BGR to grayscale
+
+        # Work on a 1-pixel padded, flattened copy : the border is labelled -1 so neighbours never need bound checks
+        height, width = image.shape
+        padded_width = width + 2
+        gray = np.pad(image, 1).ravel().astype(np.int16)
+        labels = np.full((height + 2, padded_width), -1, dtype=np.int32)
+        labels[1:-1, 1:-1] = 0   # shared visited map : 0 = not taken yet
+        labels = labels.ravel()
+        offsets = np.array([dy * padded_width + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx])
+
+        # Place the seeds, a seed already covered by an earlier one stays empty (first come)
+        seeds = np.array([(y + 1) * padded_width + x + 1 for y, x in seed_points], dtype=np.int64)
+        seed_values = np.zeros(len(seeds) + 1, dtype=np.int16)   # seed_values[label] : intensity of that region's seed
+        seed_values[1:] = gray[seeds]
+        for label, idx in enumerate(seeds, start=1):
+            if labels[idx] == 0:
+                labels[idx] = label
+        frontier = seeds[labels[seeds] == np.arange(1, len(seeds) + 1)]
+
+        if policy == "first_come":
+            self._grow_wavefront(gray, labels, frontier, seed_values, tolerance, offsets, policy, token)
+        else:
+            # Bucketed priority flood : open the next intensity-difference level only when the current one is exhausted
+            boundary = frontier
+            while boundary.size:
+                neighbours, owners, sources = self._free_neighbours(labels, boundary, offsets)
+                if not neighbours.size:
+                    break
+
+                # pixels with no free neighbour left can never grow again
+                touching = np.zeros(boundary.size, dtype=bool)
+                touching[sources] = True
+                boundary = boundary[touching]
+                level = np.abs(gray[neighbours] - seed_values[owners]).min()
+                if level > tolerance:
+                    break
+                grown = self._grow_wavefront(gray, labels, boundary, seed_values, level, offsets, policy, token)
+                boundary = np.concatenate([boundary, grown])
+
+        return labels.reshape(height + 2, padded_width)[1:-1, 1:-1].copy()
+
+    @staticmethod
+    def _free_neighbours(labels, pixels, offsets):
+        """
+         8-connected neighbours of the (flat, padded) pixels that are not labelled yet.
+         Returns (neighbour index, label it would inherit, position of the source pixel in pixels).
+        """
+        owners_of_pixels = labels[pixels]
+        neighbours, owners, sources = [], [], []
+        for offset in offsets:
+            idx = pixels + offset
+            free = np.flatnonzero(labels[idx] == 0)
+            neighbours.append(idx[free])
+            owners.append(owners_of_pixels[free])
+            sources.append(free)
+
+        return np.concatenate(neighbours), np.concatenate(owners), np.concatenate(sources)
+
+    def _grow_wavefront(self, gray, labels, frontier, seed_values, limit, offsets, policy, token=None):
+        """
+         Breadth-first growth of every region at once, one whole wavefront per step (numpy on the frontier only).
+         A pixel joins if |pixel - seed of the region reaching it| <= limit. Returns the pixels labelled here.
+        """
+        num_labels = len(seed_values)
+        grown = []
+        while frontier.size:
+            checkpoint(token)
+            neighbours, owners, _ = self._free_neighbours(labels, frontier, offsets)
+            diff = np.abs(gray[neighbours] - seed_values[owners])
+            within = diff <= limit
+            neighbours, owners, diff = neighbours[within], owners[within], diff[within]
+            if not neighbours.size:
+                break
+
+            # Collisions : several regions reach the same pixel in this step.
+            # Sort on one int64 key (pixel, then winner first) and keep the first entry of every pixel.
+            priority = owners.astype(np.int64)
+            if policy == "closest":
+                priority += diff.astype(np.int64) * num_labels
+            key = np.sort(neighbours * (num_labels * 256) + priority)
+            neighbours = key // (num_labels * 256)
+            first = np.ones(key.size, dtype=bool)
+            first[1:] = neighbours[1:] != neighbours[:-1]
+
+            frontier = neighbours[first]
+            labels[frontier] = (key[first] % (num_labels * 256)) % num_labels
+            grown.append(frontier)
+
+        return np.concatenate(grown) if grown else np.zeros(0, dtype=np.int64)
+
+    def mean_shift(self, image, token=None, image_scale=1.0):
+        """Mean shift segmentation using sliding window, returns the colour view (see mean_shift_segments)"""
+        return self.mean_shift_segments(image, token, image_scale).image
+
+    def mean_shift_segments(self, image, token=None, image_scale=1.0):
+        """
+         Mean shift segmentation using sliding window, returns a MeanShiftResult (labels, modes, counts, timing).
+         image_scale : size of image relative to the image the parameters are meant for (e.g. 0.2 for a display proxy
+                       of the loaded image) : the spatial radius shrinks with it, so a proxy gives a smaller version
+                       of the same segmentation (processed at mean_shift_scale of the proxy, a quick preview).
+         token : optional CancellationToken, checked (and given the progress) inside the engines' loops.
+                 Its previews are BGR images at the working scale : the current means of the grid engine
+                 trajectories, the rows finished so far, the labels of the last pyramid level.
+        """
         start = time.perf_counter()
+        checkpoint(token, 0, lambda: self._quick_preview(image, image_scale))
+
+        if self.mean_shift_pyramid:
+            labels_small, modes = self._mean_shift_pyramid(image, start, token, image_scale)
+        else:
+            # Downsample the image (mean_shift_scale, 1/2 resolution by default) for faster processing
+            # Process the smaller image , Converts to LUV (better for perceptual color differences)
+            small_luv = self._luv_at_scale(image, self.mean_shift_scale)
+            labels_small, modes = self._run_mean_shift(small_luv, max(1.0, self.spatial_radius * image_scale), token)
+            modes[:, 3:] /= self.mean_shift_scale
+
+        # Upsample the labels to original size
+        labels = cv2.resize(labels_small, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
+        counts = np.bincount(labels.ravel(), minlength=len(modes))
+
+        return MeanShiftResult(labels, modes, counts, time.perf_counter() - start,
+                               self.mean_shift_trajectories, self.short_circuited_trajectories)
+
+    def _quick_preview(self, image, image_scale=1.0, max_side=512):
+        """First preview, within a fraction of a second : OpenCV's mean shift filter (BGR) on a thumbnail."""
+        scale = min(1.0, max_side / max(image.shape[:2]))
+        thumbnail = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else image
+        return cv2.pyrMeanShiftFiltering(
+            thumbnail, max(1.0, self.spatial_radius * image_scale * scale / self.mean_shift_scale), self.bandwidth)
+
+    @staticmethod
+    def _luv_at_scale(image, scale):
+        """Image resized by scale (INTER_AREA) and converted to LUV float32."""
+        if scale != 1:
+            size = (max(1, int(round(image.shape[1] * scale))), max(1, int(round(image.shape[0] * scale))))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2LUV).astype(np.float32)
+
+    def _run_mean_shift(self, small_luv, spatial_radius, token=None):
+        """
+         Mean shift of a LUV image with the selected engine.
+         Returns the int32 label map and the modes table (L, U, V, y, x in small_luv coordinates).
+        """
+        if self.mean_shift_engine == "pixel":
+            return self._mean_shift_pixels(small_luv, spatial_radius, token)
+        return self._mean_shift_grid(small_luv, spatial_radius, token)
+
+    def _mean_shift_pyramid(self, image, start, token=None, image_scale=1.0):
+        """
+         Coarse to fine mean shift : modes are found once at pyramid_base_scale, then every finer level (x2, up to
+         mean_shift_target_scale) only recomputes the pixels near a segment boundary : each one takes the mode,
+         among the ones around it, closest to its own colour. Stops refining once mean_shift_time_budget is spent.
+         spatial_radius keeps its meaning (pixels at mean_shift_scale), scaled down for the base level.
+         spatial_radius shrinks with image_scale (see mean_shift_segments).
+         Returns the label map at the finest level reached and the modes table (positions in image coordinates).
+        """
+        target_scale = min(self.mean_shift_target_scale, 1.0)
+        scale = min(self.pyramid_base_scale, target_scale)
+        level_luv = self._luv_at_scale(image, scale)
+        labels, modes = self._run_mean_shift(
+            level_luv, max(1.0, self.spatial_radius * image_scale * scale / self.mean_shift_scale), token)
+        modes[:, 3:] /= scale
+
+        # float32 labels so cv2 can dilate them (exact below 2^24 modes)
+        labels = labels.astype(np.float32)
+        mode_l, mode_u, mode_v = modes[:, :3].T
+
+        reach = 2   # a boundary may move by one coarse pixel = 2 pixels of the next level
+        kernel = np.ones((2 * reach + 1, 2 * reach + 1), np.uint8)
+        offsets = [(dy, dx) for dy in range(-reach, reach + 1) for dx in range(-reach, reach + 1)]
+        while scale < target_scale:
+            checkpoint(token, preview=lambda: _luv_to_bgr(modes[labels.astype(np.int32), :3]))
+            if self.mean_shift_time_budget is not None and time.perf_counter() - start > self.mean_shift_time_budget:
+                break
+
+            scale = min(scale * 2, target_scale)
+            level_luv = self._luv_at_scale(image, scale)
+            height, width = level_luv.shape[:2]
+            labels = cv2.resize(labels, (width, height), interpolation=cv2.INTER_NEAREST)
+
+            # Boundary band : pixels with more than one mode within reach
+            ys, xs = np.nonzero(cv2.dilate(labels, kernel) != cv2.erode(labels, kernel))
+            if not ys.size:
+                continue
+
+            # Candidates : the modes within reach of the pixel, keep the closest one in colour
+            padded = cv2.copyMakeBorder(labels, reach, reach, reach, reach, cv2.BORDER_REPLICATE).astype(np.intp).ravel()
+            padded_width = width + 2 * reach
+            centers = (ys + reach) * padded_width + xs + reach
+            pixel_l, pixel_u, pixel_v = level_luv[ys, xs].T
+            best_label = padded[centers]
+            best_dist = np.full(ys.size, np.inf, np.float32)
+            for dy, dx in offsets:
+                candidate = padded[centers + dy * padded_width + dx]
+                dist = ((mode_l[candidate] - pixel_l) ** 2 + (mode_u[candidate] - pixel_u) ** 2
+                        + (mode_v[candidate] - pixel_v) ** 2)
+                closer = dist < best_dist
+                best_label = np.where(closer, candidate, best_label)
+                best_dist = np.minimum(dist, best_dist)
+            labels[ys, xs] = best_label
+
+        return labels.astype(np.int32), modes
+
+    def _mode_step(self, spatial_radius):
+        """Modes closer than one step (on L, U, V, y, x) are first collapsed into one point."""
+        return np.array([max(1.0, self.bandwidth / self.basin_fraction)] * 3
+                        + [max(1.0, spatial_radius / self.basin_fraction)] * 2)
+
+    def _group_modes(self, modes, weights, spatial_radius):
+        """
+         Merges the modes lying within bandwidth (L, U, V) and spatial_radius (y, x) of each other : the heaviest mode
+         left takes every unassigned mode within that window, then the next heaviest, and so on (not transitive, so
+         a colour gradient is not chained into one segment).
+         Returns the weighted mean of every group and the group of every input mode.
+        """
+        # Step 1: Collapse the modes sharing a cell of one step (trajectories ending on the same mode)
+        quantized = np.floor(modes / self._mode_step(spatial_radius)).astype(np.int64)
+        quantized -= quantized.min(axis=0)
+        _, point = np.unique(np.ravel_multi_index(quantized.T, quantized.max(axis=0) + 1), return_inverse=True)
+        point = point.ravel()
+        totals = np.bincount(point, weights=weights)
+        points = np.stack([np.bincount(point, weights=weights * modes[:, c]) for c in range(5)], axis=1)
+        points /= totals[:, None]
+
+        # Step 2: Cells of spatial_radius x spatial_radius x bandwidth on L (L varying fastest) :
+        # the window around a point lies inside the 3x3x3 cells around the point's cell
+        bandwidth, radius = max(self.bandwidth, 1e-6), max(spatial_radius, 1e-6)
+        quantized = np.floor(points[:, [3, 4, 0]] / (radius, radius, bandwidth)).astype(np.int64)
+        quantized -= quantized.min(axis=0) - 1
+        dims = quantized.max(axis=0) + 2
+        cells = np.ravel_multi_index(quantized.T, dims)
+        by_cell = np.argsort(cells, kind="stable")
+        sorted_cells = cells[by_cell]
+        spatial_offsets = np.array([dy * dims[1] + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1)]) * dims[2]
+        colours, positions = points[:, :3], points[:, 3:]
+
+        # Step 3: Heaviest first, every point not taken yet starts a group with the free points of its window
+        group = np.full(len(points), -1)
+        groups = 0
+        for centre in np.argsort(-totals, kind="stable"):
+            if group[centre] >= 0:
+                continue
+            first_cells = cells[centre] + spatial_offsets - 1
+            bounds = np.searchsorted(sorted_cells, np.concatenate([first_cells, first_cells + 3]))
+            candidates = np.concatenate([by_cell[a:b] for a, b in zip(bounds[:9], bounds[9:])])
+            candidates = candidates[group[candidates] < 0]
+            within = ((((colours[candidates] - colours[centre]) ** 2).sum(axis=1) <= bandwidth ** 2)
+                      & (((positions[candidates] - positions[centre]) ** 2).sum(axis=1) <= radius ** 2))
+            group[candidates[within]] = groups
+            groups += 1
 
-        # Downsample the image (1/2 resolution) for faster processing
-        scale_factor = 0.5
-        small_image = cv2.resize(image, None, fx=scale_factor, fy=scale_factor, interpolation=cv2.INTER_AREA)
+        group = group[point]
+        totals = np.bincount(group, weights=weights)
+        grouped = np.stack([np.bincount(group, weights=weights * modes[:, c]) for c in range(5)], axis=1)
+        return (grouped / totals[:, None]).astype(np.float32), group
 
-        # Process the smaller image , Converts to LUV (better for perceptual color differences)
-        small_luv = cv2.cvtColor(small_image, cv2.COLOR_BGR2LUV).astype(np.float32)
+    def _mean_shift_grid(self, small_luv, spatial_radius=None, token=None):
+        """
+         Grid accelerated mean shift : every window only looks at pixels of the grid cells around its mean
+         (cells of spatial_radius x spatial_radius, binned by bandwidth on L), instead of the entire image.
+         Pixels sharing a small spatial cell and LUV colour bin are first collapsed into one weighted point
+         (their mean colour / position), and one trajectory runs per point, all points of a grid cell at once.
+         Same window as the pixel loop : |pos - mean_pos| <= spatial_radius and |color - mean_color| <= bandwidth.
+        """
+        height, width = small_luv.shape[:2]
+        radius = self.spatial_radius if spatial_radius is None else spatial_radius
+        bandwidth = self.bandwidth
+
+        # Step 1: Bin pixels (fine spatial cell x colour bin) into weighted points
+        point_step = max(1, int(radius) // 5)
+        colour_step = max(1, int(bandwidth) // 4)
+        colour_bins = 256 // colour_step + 1
+        y_coords, x_coords = np.indices((height, width))
+        y_coords, x_coords = y_coords.ravel(), x_coords.ravel()
+        colors = small_luv.reshape(-1, 3)
+
+        bins = (colors // colour_step).astype(np.int64)
+        key = (y_coords // point_step) * (width // point_step + 1) + x_coords // point_step
+        for channel in range(3):
+            key = key * colour_bins + bins[:, channel]
+        _, pixel_point, counts = np.unique(key, return_inverse=True, return_counts=True)
+        pixel_point = pixel_point.ravel()
+
+        def point_sum(values):
+            return np.bincount(pixel_point, weights=values, minlength=len(counts))
+
+        # features summed over a window in one matrix product : [count, sum L, sum U, sum V, sum y, sum x]
+        features = np.stack([counts.astype(np.float64)] + [point_sum(colors[:, c]) for c in range(3)]
+                            + [point_sum(y_coords), point_sum(x_coords)], axis=1)
+        point_color = (features[:, 1:4] / counts[:, None]).astype(np.float32)
+        point_pos = (features[:, 4:6] / counts[:, None]).astype(np.float32)
+        features = features.astype(np.float32)
+
+        # Step 2: Grid of cells (spatial radius x spatial radius x bandwidth on L),
+        # a window around a point lies inside the 3x3x3 cells around the point's cell
+        cell = max(1, int(np.ceil(radius)))
+        lightness_cell = max(1, int(np.ceil(bandwidth)))
+        grid_width = width // cell + 1
+        lightness_bins = 256 // lightness_cell + 2
+
+        def cell_of(pos, color):
+            spatial = (pos[:, 0] // cell).astype(np.int64) * grid_width + (pos[:, 1] // cell).astype(np.int64)
+            return spatial * lightness_bins + (color[:, 0] // lightness_cell).astype(np.int64)
+
+        point_cells = cell_of(point_pos, point_color)
+        by_cell = np.argsort(point_cells, kind="stable")
+        cell_start = np.searchsorted(point_cells[by_cell], np.arange((height // cell + 2) * grid_width * lightness_bins + 1))
+        neighbourhoods = {}
+
+        def window_candidates(c):
+            if c not in neighbourhoods:
+                spatial, lightness = divmod(c, lightness_bins)
+                cy, cx = divmod(spatial, grid_width)
+                parts = []
+                for ny in range(max(cy - 1, 0), cy + 2):
+                    for nx in range(max(cx - 1, 0), min(cx + 2, grid_width)):
+                        first = (ny * grid_width + nx) * lightness_bins + max(lightness - 1, 0)
+                        last = (ny * grid_width + nx) * lightness_bins + min(lightness + 2, lightness_bins)
+                        parts.append(by_cell[cell_start[first]:cell_start[last]])
+                neighbourhoods[c] = np.concatenate(parts)
+            return neighbourhoods[c]
+
+        # squared norms for |a - b|^2 = |a|^2 + |b|^2 - 2 a.b (distances as matrix products)
+        point_pos_sq = (point_pos ** 2).sum(axis=1)
+        point_color_sq = (point_color ** 2).sum(axis=1)
+
+        # Step 3: Iterate every trajectory (starting at its point), grouped by the cell it currently sits in.
+        # With mode sharing every position a trajectory visits (within a small radius) is recorded with it as owner,
+        # and a trajectory stepping onto a recorded position stops there : it ends on its owner's mode.
+        mean_color = point_color.copy()
+        mean_pos = point_pos.copy()
+        active = np.arange(len(counts))
+        leader = np.arange(len(counts))   # trajectory whose mode this one ends on (itself unless short-circuited)
+
+        basin_step = np.array([max(1.0, radius / self.basin_fraction)] * 2 + [max(1.0, bandwidth / self.basin_fraction)] * 3)
+        basin_dims = (np.array([height, width, 256, 256, 256]) / basin_step).astype(np.int64) + 1
+        basin_keys = np.zeros(0, dtype=np.int64)     # sorted visited positions (quantized y, x, L, U, V) ...
+        basin_owners = np.zeros(0, dtype=np.int64)   # ... and the trajectory that visited each first
+        self.mean_shift_trajectories = len(counts)
+        self.short_circuited_trajectories = 0
+
+        def preview():
+            # every pixel in the colour its trajectory has reached so far
+            return _luv_to_bgr(mean_color[leader][pixel_point].reshape(height, width, 3))
+
+        for iteration in range(self.max_iterations):
+            checkpoint(token, iteration / self.max_iterations, preview)
+            if self.mean_shift_mode_sharing and active.size:
+                quantized = (np.hstack([mean_pos[active], mean_color[active]]) / basin_step).astype(np.int64)
+                keys = np.ravel_multi_index(quantized.T, basin_dims, mode="clip")
+                unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+                owners = active[first]   # first trajectory on each position in this iteration ...
+                known = np.zeros(unique_keys.size, dtype=bool)
+                if basin_keys.size:
+                    at = np.searchsorted(basin_keys, unique_keys).clip(max=basin_keys.size - 1)
+                    known = basin_keys[at] == unique_keys
+                    owners[known] = basin_owners[at[known]]   # ... unless it was visited in an earlier one
+
+                leader[active] = owners[inverse.ravel()]
+                followers = leader[active] != active
+                self.short_circuited_trajectories += np.count_nonzero(followers)
+                active = active[~followers]
+
+                basin_keys = np.concatenate([basin_keys, unique_keys[~known]])
+                basin_owners = np.concatenate([basin_owners, owners[~known]])
+                order = np.argsort(basin_keys, kind="stable")
+                basin_keys, basin_owners = basin_keys[order], basin_owners[order]
+
+            if not active.size:
+                break
+
+            cells = cell_of(mean_pos[active], mean_color[active])
+            order = np.argsort(cells, kind="stable")
+            active, cells = active[order], cells[order]
+            starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+            sums = np.empty((active.size, 6), dtype=np.float32)
+
+            for begin, end in zip(starts, np.r_[starts[1:], active.size]):
+                checkpoint(token)
+                group = active[begin:end]
+                candidates = window_candidates(int(cells[begin]))
+                group_pos, group_color = mean_pos[group], mean_color[group]
+
+                # Pixels within both spatial_radius and bandwidth (flat kernel)
+                spatial_dist_sq = ((group_pos ** 2).sum(axis=1)[:, None] + point_pos_sq[candidates]
+                                   - 2 * group_pos @ point_pos[candidates].T)
+                color_dist_sq = ((group_color ** 2).sum(axis=1)[:, None] + point_color_sq[candidates]
+                                 - 2 * group_color @ point_color[candidates].T)
+                window = (spatial_dist_sq <= radius ** 2) & (color_dist_sq <= bandwidth ** 2)
+                sums[begin:end] = window.astype(np.float32) @ features[candidates]
+
+            # Empty window -> stop where it is
+            has_window = sums[:, 0] > 0
+            active, sums = active[has_window], sums[has_window]
+            new_mean_color = sums[:, 1:4] / sums[:, :1]
+            new_mean_pos = sums[:, 4:6] / sums[:, :1]
+
+            # Check convergence : If the mean shifts very little (<1), assume convergence (and keep the current mean).
+            moving = ((np.linalg.norm(new_mean_color - mean_color[active], axis=1) >= 1) |
+                      (np.linalg.norm(new_mean_pos - mean_pos[active], axis=1) >= 1))
+            active = active[moving]
+            mean_color[active] = new_mean_color[moving]
+            mean_pos[active] = new_mean_pos[moving]
+
+        # Follow the owners up to the trajectory that actually converged
+        # (two trajectories stepping on each other's positions in the same iteration keep their own result)
+        for _ in range(64):
+            next_leader = leader[leader]
+            if np.array_equal(next_leader, leader):
+                break
+            leader = next_leader
+        unresolved = leader[leader] != leader
+        leader[unresolved] = np.flatnonzero(unresolved)
+
+        # Segments : the modes reached (merged when within the window of each other), weighted by pixel counts
+        modes, point_mode = self._group_modes(np.hstack([mean_color[leader], mean_pos[leader]]).astype(np.float64),
+                                              counts, radius)
+        return point_mode[pixel_point].reshape(height, width).astype(np.int32), modes
+
+    def _mean_shift_pixels(self, small_luv, spatial_radius=None, token=None):
+        """Reference per-pixel loop : every window is computed against the entire image (very slow)."""
+        spatial_radius = self.spatial_radius if spatial_radius is None else spatial_radius
         height, width = small_luv.shape[:2]
-        segmented_small = np.zeros_like(small_luv)
+        pixel_modes = np.zeros((height, width, 5), dtype=np.float64)   # L, U, V, y, x reached by every pixel
+        self.mean_shift_trajectories = height * width
+        self.short_circuited_trajectories = 0
 
         # Precompute spatial grid
         y_coords, x_coords = np.indices((height, width))
 
+        def preview():
+            # rows done in the colour of their modes, the others as they are
+            view = small_luv.copy()
+            view[:y] = pixel_modes[:y, :, :3]
+            return _luv_to_bgr(view)
+
         for y in range(height):
+            checkpoint(token, y / height, preview)
             for x in range(width):
                 current_color = small_luv[y, x]
                 current_pos = np.array([y, x], dtype=np.float32)
@@ -98,7 +758,7 @@ class ImageSegmenter:
                     # Compute distances
                     spatial_dist_sq = (y_coords - mean_pos[0]) ** 2 + (x_coords - mean_pos[1]) ** 2  # Squared Euclidean distance from mean_pos
                     color_dist_sq = np.sum((small_luv - mean_color) ** 2, axis=2)       # Squared LUV color difference from mean_color.
-                    mask = (spatial_dist_sq <= self.spatial_radius ** 2) & (color_dist_sq <= self.bandwidth ** 2) # Pixels within both spatial_radius and bandwidth.
+                    mask = (spatial_dist_sq <= spatial_radius ** 2) & (color_dist_sq <= self.bandwidth ** 2) # Pixels within both spatial_radius and bandwidth.
                     if not np.any(mask):
                         break
 
@@ -121,14 +781,8 @@ class ImageSegmenter:
                     mean_color = new_mean_color
                     mean_pos = new_mean_pos
 
-                segmented_small[y, x] = mean_color
-
-        # Convert back to RGB
-        segmented_small = cv2.cvtColor(segmented_small.astype(np.uint8), cv2.COLOR_LUV2BGR)
+                pixel_modes[y, x] = np.r_[mean_color, mean_pos]
 
-        # Upsample the result to original size
-        segmented = cv2.resize(segmented_small, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_LINEAR)
+        modes, pixel_mode = self._group_modes(pixel_modes.reshape(-1, 5), np.ones(height * width), spatial_radius)
+        return pixel_mode.reshape(height, width).astype(np.int32), modes
 
-        end = time.perf_counter()
-        print(f"Mean shift executed in {end - start:.4f} seconds")
-        return segmented
\ No newline at end of file
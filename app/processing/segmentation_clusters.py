@@ -1,8 +1,24 @@
+import heapq
+import math
+
 import numpy as np
 import cv2
 
+from app.utils.cancellation import checkpoint
+
+
+def kMeans_segmentation(image, k=3, maximum_iterations=100, init="k-means++", tolerance=0.1,
+                        colour_histogram=False, histogram_bits=8):
+    """
+     k-means with k-means++ ("k-means++"), colour histogram ("histogram") or random ("random") seeding,
+     Hamerly bounds (only points whose closest centroid may have changed get their distances recomputed)
+     and stops once no centroid moves by tolerance (intensity levels) or more.
+     colour_histogram : cluster the image's colours (8-bit images, histogram_bits per channel, 8 = exact colours)
+     weighted by their pixel counts instead of the resized pixels, labels of the full image size.
+    """
+    if colour_histogram:
+        return _histogram_kmeans(image, k, maximum_iterations, init, tolerance, histogram_bits)
 
-def kMeans_segmentation(image, k=3, maximum_iterations=100):
     # Step 1: Resize (keep it for now, practical)
     image = cv2.resize(image, (256, 256))
 
@@ -10,88 +26,828 @@ def kMeans_segmentation(image, k=3, maximum_iterations=100):
     img_data = image.reshape((-1, 3)) if len(image.shape) == 3 else image.reshape((-1, 1))
     img_data = np.float32(img_data)
 
-    # Step 3: Initialize random centroids
-    np.random.seed(42)
-    random_idxs = np.random.choice(len(img_data), k, replace=False)
-    centroids = img_data[random_idxs]
+    # Step 3: Initialize centroids
+    rng = np.random.default_rng(42)
+    centroids = _initial_centroids(img_data, k, init, rng)
+
+    # Step 4: Iterate (assignment / update)
+    labels, _ = _hamerly_kmeans(img_data, centroids, maximum_iterations, tolerance)
+
+    # Step 5: Postprocess
+    segmented_img = labels.reshape((image.shape[0], image.shape[1]))
+
+    return segmented_img
+
+
+def _histogram_kmeans(image, k, maximum_iterations, init, tolerance, bits):
+    """
+     Weighted k-means on the occupied bins of the image's colour histogram (bits per channel), every bin standing
+     for the mean colour of its pixels, then labels mapped back to the pixels through their occupied bin.
+    """
+    # Step 1: Histogram : bin of every pixel, pixel count and mean colour of every occupied bin
+    channels = image.reshape(image.shape[0], image.shape[1], -1)
+    pixel_bin = np.zeros(image.shape[:2], dtype=np.int32)
+    for c in range(channels.shape[2]):
+        pixel_bin = (pixel_bin << bits) | (channels[:, :, c] >> (8 - bits))
+    # occupied bins only (sorted) : no dense 2^(channels x bits) arrays, bin_of is the occupied bin of every pixel
+    occupied, bin_of, counts = np.unique(pixel_bin.ravel(), return_inverse=True, return_counts=True)
+    bin_of = bin_of.ravel()
+    if bits == 8:   # the bin is the colour
+        colours = np.stack([(occupied >> (8 * (channels.shape[2] - 1 - c))) & 255
+                            for c in range(channels.shape[2])], axis=1)
+    else:
+        colours = np.stack([np.bincount(bin_of, weights=channels[:, :, c].ravel(), minlength=len(counts))
+                            for c in range(channels.shape[2])], axis=1) / counts[:, None]
+    weights = counts.astype(np.float64)
+
+    # Step 2: Weighted k-means on the colours
+    rng = np.random.default_rng(42)
+    centroids = _initial_centroids(colours.astype(np.float32), k, init, rng, weights)
+    labels, _ = _hamerly_kmeans(colours.astype(np.float32), centroids, maximum_iterations, tolerance, weights)
+
+    # Step 3: Map back through the occupied bin of every pixel
+    return labels.astype(np.int32)[bin_of].reshape(image.shape[:2])
+
+
+def _initial_centroids(data, k, init, rng, weights=None):
+    """
+     k starting centroids for data (N x channels float32, optional point weights) :
+     "k-means++", "histogram" or "random".
+    """
+    weights = np.ones(len(data)) if weights is None else weights
+    if init == "random":
+        return data[rng.choice(len(data), k, replace=len(data) < k, p=weights / weights.sum())]
+    if init == "histogram":
+        # k-means++ over the occupied bins of a coarse colour histogram (8 levels per channel), weighted by counts
+        bins = (data // 32).astype(np.int64) @ (8 ** np.arange(data.shape[1]))
+        occupied, bin_of = np.unique(bins, return_inverse=True)
+        bin_of = bin_of.ravel()
+        counts = np.bincount(bin_of, weights=weights)
+        bin_means = np.stack([np.bincount(bin_of, weights=weights * data[:, c]) for c in range(data.shape[1])],
+                             axis=1) / counts[:, None]
+        if len(occupied) >= k:
+            return _kmeans_plus_plus(bin_means.astype(np.float32), k, rng, counts)
+        return _kmeans_plus_plus(data, k, rng, weights)
+    if init == "k-means++":
+        return _kmeans_plus_plus(data, k, rng, weights)
+    raise ValueError(f"Unknown k-means initialization: {init}")
+
+
+def _kmeans_plus_plus(data, k, rng, weights=None):
+    """k-means++ seeding : every next centroid is drawn with probability ~ weight x squared distance to the closest one."""
+    weights = np.ones(len(data)) if weights is None else weights
+    centroids = [data[rng.choice(len(data), p=weights / weights.sum())]]
+    closest_sq = ((data - centroids[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        probabilities = weights * closest_sq
+        if probabilities.sum() <= 0:   # fewer distinct colours than k
+            probabilities = weights
+        centroids.append(data[rng.choice(len(data), p=probabilities / probabilities.sum())])
+        closest_sq = np.minimum(closest_sq, ((data - centroids[-1]) ** 2).sum(axis=1))
+    return np.array(centroids, dtype=np.float32)
+
+
+def _hamerly_kmeans(data, centroids, maximum_iterations, tolerance, weights=None):
+    """
+     Lloyd iterations with Hamerly bounds : every point keeps an upper bound on the distance to its centroid and a
+     lower bound on the distance to the second closest. Both follow the centroid shifts, and a point is only
+     re-assigned (all its distances computed) when its upper bound exceeds max(lower bound, half the gap between
+     its centroid and the closest other one). Optional weights : every point counts as that many.
+     Returns the labels and the centroids.
+    """
+    k = len(centroids)
+    everything = np.arange(len(data))
+    centroids = centroids.astype(np.float32)
+
+    def assign(points):
+        distances = np.sqrt(np.maximum(_squared_distances(data[points], centroids), 0))
+        nearest = np.argmin(distances, axis=1)
+        rows = np.arange(len(points))
+        nearest_distance = distances[rows, nearest]
+        distances[rows, nearest] = np.inf
+        return nearest, nearest_distance, distances.min(axis=1)
+
+    labels, upper, lower = assign(everything)
 
     for iteration in range(maximum_iterations):
-        # Step 4: Assignment step
-        distances = np.linalg.norm(img_data[:, np.newaxis] - centroids, axis=2)
-        labels = np.argmin(distances, axis=1)
-
-        # Step 5: Update step safely
-        new_centroids = []
-        for i in range(k):
-            if np.any(labels == i):
-                new_centroid = img_data[labels == i].mean(axis=0)
-            else:
-                # If no points assigned to this cluster, reinitialize randomly
-                new_centroid = img_data[np.random.choice(len(img_data))]
-            new_centroids.append(new_centroid)
-        new_centroids = np.array(new_centroids)
-
-        # Step 6: Convergence check
-        if np.allclose(centroids, new_centroids):
+        # Update step (an emptied cluster restarts on the point farthest from its centroid, points sitting on their
+        # centroid excepted : with fewer distinct points than k the remaining clusters stay empty)
+        counts = np.bincount(labels, weights=weights, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=data[:, c] if weights is None else weights * data[:, c], minlength=k)
+                         for c in range(data.shape[1])], axis=1)
+        new_centroids = centroids.copy()
+        new_centroids[counts > 0] = sums[counts > 0] / counts[counts > 0, None]
+        empty = np.flatnonzero(counts == 0)
+        if empty.size:
+            farthest = np.argsort(upper)[::-1][:empty.size]
+            farthest = farthest[upper[farthest] > 0]
+            new_centroids[empty[:farthest.size]] = data[farthest]
+            upper[farthest] = np.inf   # reassigned below
+
+        # Convergence check
+        shift = np.linalg.norm(new_centroids - centroids, axis=1)
+        centroids = new_centroids.astype(np.float32)
+        if shift.max() < tolerance:
             break
 
-        centroids = new_centroids
+        # Bounds follow the shifts : own centroid for the upper bound, largest other shift for the lower one
+        upper += shift[labels]
+        largest, second = np.argsort(shift)[::-1][:2] if k > 1 else (0, 0)
+        lower -= np.where(labels == largest, shift[second], shift[largest])
 
-    # Step 7: Postprocess
-    segmented_img = labels.reshape((image.shape[0], image.shape[1]))
+        gaps = np.sqrt(np.maximum(_squared_distances(centroids, centroids), 0))
+        np.fill_diagonal(gaps, np.inf)
+        bound = np.maximum(gaps.min(axis=1)[labels] / 2, lower)
 
-    return segmented_img
+        # Points that may have a new closest centroid : tighten the upper bound first, then reassign
+        check = np.flatnonzero(upper > bound)
+        upper[check] = np.linalg.norm(data[check] - centroids[labels[check]], axis=1)
+        check = check[upper[check] > bound[check]]
+        if check.size:
+            labels[check], upper[check], lower[check] = assign(check)
 
+    return labels, centroids
 
-def agglomerative_segmentation(image, k=3):
-    image = cv2.resize(image, (64, 64))
 
-    if len(image.shape) == 3:
-        img_data = image.reshape((-1, 3))
-    else:
-        img_data = image.reshape((-1, 1))
-    img_data = np.float32(img_data)
-    num_pixels = img_data.shape[0]
+def _squared_distances(data, centroids):
+    """|x - c|^2 of every row of data to every centroid, via |x|^2 - 2 x.c + |c|^2 (no N x k x channels tensor)."""
+    return (data ** 2).sum(axis=1)[:, None] - 2 * data @ centroids.T + (centroids ** 2).sum(axis=1)
+
+
+def mini_batch_kMeans_segmentation(image, k=3, batch_size=4096, maximum_iterations=100, chunk_size=262144, token=None,
+                                   preview_size=512):
+    """
+     Mini-batch k-means on the full resolution image : centroids are fitted on random batches of pixels
+     (every centroid is the running mean of all the pixels assigned to it so far), then every pixel is labelled
+     in chunks of chunk_size, so the memory used besides the label map does not depend on the image size.
+     Returns an int32 label map of the input size.
+     token : optional CancellationToken, checked every iteration / chunk. Its previews are the label maps of
+             a thumbnail (preview_size on the long side) with the centroids of the current iteration.
+    """
+    pixels = image.reshape((-1, 3)) if len(image.shape) == 3 else image.reshape((-1, 1))   # view, no float copy
+
+    # Step 1: Initialize : k-means++ centroids refined by plain k-means on one batch
+    rng = np.random.default_rng(42)
+    sample = pixels[rng.integers(0, len(pixels), batch_size)].astype(np.float32)
+    _, centroids = _hamerly_kmeans(sample, _kmeans_plus_plus(sample, k, rng), maximum_iterations, 0.1)
+    seen = np.zeros(k)   # pixels assigned to every centroid so far
+    thumbnail = []
+
+    def preview():
+        if not thumbnail:
+            thumbnail.append(_thumbnail(image, preview_size))
+        small = thumbnail[0]
+        small_pixels = small.reshape((-1, pixels.shape[1])).astype(np.float32)
+        return _assign_labels(small_pixels, centroids).reshape(small.shape[:2])
+
+    for iteration in range(maximum_iterations):
+        checkpoint(token, preview=preview)
+        # Step 2: Assign a random batch
+        batch = pixels[rng.integers(0, len(pixels), batch_size)].astype(np.float32)
+        labels = _assign_labels(batch, centroids)
+
+        # Step 3: Move every centroid to the running mean of its pixels
+        batch_counts = np.bincount(labels, minlength=k)
+        batch_sums = np.stack([np.bincount(labels, weights=batch[:, c], minlength=k)
+                               for c in range(batch.shape[1])], axis=1)
+        seen += batch_counts
+        assigned = batch_counts > 0
+        new_centroids = centroids.copy()
+        new_centroids[assigned] += ((batch_sums[assigned] - batch_counts[assigned, None] * centroids[assigned])
+                                    / seen[assigned, None])
+
+        # If no pixel was ever assigned to a cluster, reinitialize it randomly
+        empty = seen == 0
+        new_centroids[empty] = batch[rng.choice(batch_size, np.count_nonzero(empty))]
+
+        # Step 4: Convergence check (centroids move by less than a tenth of an intensity level)
+        converged = np.abs(new_centroids - centroids).max() < 0.1
+        centroids = new_centroids.astype(np.float32)
+        if converged:
+            break
+
+    # Step 5: Label the full image chunk by chunk
+    labels = np.empty(len(pixels), dtype=np.int32)
+    for start in range(0, len(pixels), chunk_size):
+        checkpoint(token, start / len(pixels))
+        labels[start:start + chunk_size] = _assign_labels(pixels[start:start + chunk_size].astype(np.float32), centroids)
+
+    return labels.reshape(image.shape[:2])
+
+
+def _thumbnail(image, max_side):
+    """image shrunk (INTER_AREA) so its long side is at most max_side pixels."""
+    scale = max_side / max(image.shape[:2])
+    if scale >= 1:
+        return image
+    size = (max(1, int(image.shape[1] * scale)), max(1, int(image.shape[0] * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def _assign_labels(data, centroids):
+    """Closest centroid of every row of data (squared distances without |x|^2, the same for every centroid)."""
+    return np.argmin((centroids ** 2).sum(axis=1) - 2 * data @ centroids.T, axis=1)
+
+
+class AgglomerativeTree:
+    """
+     Full merge history of an agglomerative clustering, cut at any k without clustering again.
+     linkage : (merges x 3) array of (kept, merged, distance) in merge order (the merged item keeps the id kept)
+     pixel_item : item (colour / region) of every pixel, shape : label map shape
+     colours / weights : optional mean colour and pixel count of every item (see label_image)
+    """
+    def __init__(self, linkage, pixel_item, item_count, shape, colours=None, weights=None):
+        self.linkage = linkage
+        self.pixel_item = pixel_item
+        self.item_count = item_count
+        self.shape = shape
+        self.colours = colours
+        self.weights = weights
+
+    def cut(self, k):
+        """int32 label map with k clusters (or as few as the merges allow), labels in order of first appearance."""
+        merges = self.linkage[:max(self.item_count - k, 0)]
+        return _merged_labels(merges, self.item_count, self.pixel_item).reshape(self.shape)
+
+    def label_image(self, image, k, chunk_size=262144, token=None):
+        """
+         int32 label map of image (any size, e.g. the full resolution image the tree was built on a resized copy of) :
+         every pixel gets the cluster of the cut at k whose mean colour is closest to its own, labels numbered as
+         in cut(k). Needs the item colours (trees of agglomerative_tree).
+        """
+        # Step 1: Mean colour of every cluster of the cut
+        labels = self.cut(k).ravel()
+        item_cluster = np.zeros(self.item_count, dtype=np.int64)
+        item_cluster[self.pixel_item] = labels
+        clusters = int(labels.max()) + 1
+        sizes = np.bincount(item_cluster, weights=self.weights, minlength=clusters)
+        means = np.stack([np.bincount(item_cluster, weights=self.weights * self.colours[:, c], minlength=clusters)
+                          for c in range(self.colours.shape[1])], axis=1) / sizes[:, None]
+        means = means.astype(np.float32)
+
+        # Step 2: Closest mean of every pixel, chunk by chunk
+        pixels = image.reshape((-1, means.shape[1]))
+        image_labels = np.empty(len(pixels), dtype=np.int32)
+        for start in range(0, len(pixels), chunk_size):
+            checkpoint(token, start / len(pixels))
+            image_labels[start:start + chunk_size] = _assign_labels(
+                pixels[start:start + chunk_size].astype(np.float32), means)
+        return image_labels.reshape(image.shape[:2])
+
+
+def agglomerative_segmentation(image, k=3, size=(256, 256)):
+    """
+     Centroid linkage agglomerative clustering of the pixel colours (image resized to size, None = full size).
+     Returns an int32 label map, labels numbered in order of first appearance (see agglomerative_tree).
+    """
+    return agglomerative_tree(image, size).cut(k)
+
+
+def agglomerative_tree(image, size=(256, 256), token=None):
+    """
+     Centroid linkage merge tree of the pixel colours (image resized to size, None = full size).
+     Pixels of the same colour start as one weighted cluster (they merge first anyway, at distance 0),
+     clusters are merged by a heap of nearest neighbours (see _centroid_linkage) down to a single one.
+     A merge only looks at the clusters within reach of the merged one (all of them for the last few thousand) :
+     at the default size typical photos have 15-20k colours (2-3 s), very colourful ones ~38k (~7 s).
+     Labels of the full image come from the cut's mean colours (see AgglomerativeTree.label_image).
+     token : optional CancellationToken, checked while merging. Its previews are BGR images of the
+             resized image, every pixel in the mean colour of its cluster so far.
+    """
+    if size is not None:
+        image = cv2.resize(image, size)
+    checkpoint(token, 0, lambda: image)   # before any merge every pixel is its own colour
+
+    # Step 1: Unique colours and their pixel counts
+    img_data = image.reshape((-1, 3)) if len(image.shape) == 3 else image.reshape((-1, 1))
+    colours, pixel_colour, counts = np.unique(img_data, axis=0, return_inverse=True, return_counts=True)
+
+    # Step 2: Merge down to one cluster
+    def preview(merges):
+        labels = _merged_labels(merges, len(colours), pixel_colour.ravel())
+        sizes = np.bincount(labels)
+        means = np.stack([np.bincount(labels, weights=img_data[:, c]) for c in range(img_data.shape[1])], axis=1)
+        return np.rint(means / sizes[:, None]).astype(np.uint8)[labels].reshape(image.shape)
+
+    merges = _centroid_linkage(colours, counts, token=token, preview=preview)
+
+    return AgglomerativeTree(np.array(merges, dtype=np.float64).reshape(-1, 3), pixel_colour.ravel(), len(colours),
+                             image.shape[:2], colours.astype(np.float64), counts.astype(np.float64))
 
-    # Step 1: Initialize
-    clusters = {i: [i] for i in range(num_pixels)}  # each pixel its own cluster
-    centroids = {i: img_data[i] for i in range(num_pixels)}  # cluster centers
 
-    # Build initial distance matrix
-    distances = np.linalg.norm(img_data[:, np.newaxis] - img_data[np.newaxis, :], axis=2)
-    np.fill_diagonal(distances, np.inf)
+def region_graph_segmentation(image, k=3, cell_size=8):
+    """
+     Spatially constrained agglomerative clustering of the full resolution image.
+     Returns an int32 label map of the image size, labels numbered in order of first appearance (see region_graph_tree).
+    """
+    return region_graph_tree(image, cell_size).cut(k)
 
-    while len(clusters) > k:
-        idx = np.argmin(distances)
-        i, j = divmod(idx, num_pixels)
 
-        if i == j or i not in clusters or j not in clusters:
-            distances[i, j] = np.inf
+def region_graph_tree(image, cell_size=8, token=None):
+    """
+     Spatially constrained merge tree of the full resolution image : the image is first cut into
+     cell_size x cell_size grid cells (the over-segmentation), then only adjacent regions (region adjacency graph,
+     4-connectivity) are merged, closest mean colours first (see _graph_linkage), down to a single region.
+     token : optional CancellationToken, checked while merging.
+    """
+    height, width = image.shape[:2]
+    channels = image.reshape(height, width, -1)
+
+    # Step 1: Over-segmentation : grid cells, their pixel counts and mean colours
+    grid_width = (width + cell_size - 1) // cell_size
+    cells = ((np.arange(height, dtype=np.int32) // cell_size)[:, None] * grid_width
+             + (np.arange(width, dtype=np.int32) // cell_size)[None, :])
+    counts = np.bincount(cells.ravel())
+    colours = np.stack([np.bincount(cells.ravel(), weights=channels[:, :, c].ravel()) for c in range(channels.shape[2])],
+                       axis=1) / counts[:, None]
+
+    # Step 2: Merge adjacent regions down to one
+    merges = _graph_linkage(colours, counts, _region_adjacency(cells), token=token)
+
+    return AgglomerativeTree(np.array(merges, dtype=np.float64).reshape(-1, 3), cells.ravel(), len(counts),
+                             (height, width))
+
+
+def _region_adjacency(labels):
+    """Edges (sorted pairs, each once) between regions of a label map touching horizontally or vertically."""
+    pairs = []
+    for first, second in ((labels[:, :-1], labels[:, 1:]), (labels[:-1], labels[1:])):
+        boundary = first != second
+        pairs.append(np.stack([first[boundary], second[boundary]], axis=1).astype(np.int64))
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    count = int(labels.max()) + 1
+    keys = np.unique(pairs[:, 0] * count + pairs[:, 1])
+    return np.stack([keys // count, keys % count], axis=1)
+
+
+def _graph_linkage(points, weights, edges, clusters=1, token=None):
+    """
+     Centroid linkage of weighted points restricted to a graph : only the two ends of an edge can merge, and
+     the merged region inherits the neighbours of both. Every region keeps its nearest neighbour (among its graph
+     neighbours) in arrays and a heap holds (distance to it, region), as in _centroid_linkage : after a merge only
+     the merged region's neighbours are looked at, and only those whose nearest neighbour took part in it are rescanned.
+     Memory is linear in the number of points and edges. The token (if any) is checked every 1024 merges.
+     Returns the merges in order : (kept, merged, distance), the merged region keeps the id kept.
+    """
+    n = len(points)
+    centroids = points.astype(np.float64)
+    sizes = np.asarray(weights, dtype=np.float64).copy()
+    neighbours = [set() for _ in range(n)]
+    for first, second in edges.tolist():
+        neighbours[first].add(second)
+        neighbours[second].add(first)
+
+    def distances_to(region, around):
+        return np.sqrt(((centroids[around] - centroids[region]) ** 2).sum(axis=1))
+
+    # Nearest neighbour of every region : closest end of its edges (ties to the lowest index)
+    ends = np.concatenate([edges, edges[:, ::-1]])
+    edge_distances = np.sqrt(((centroids[ends[:, 0]] - centroids[ends[:, 1]]) ** 2).sum(axis=1))
+    order = np.lexsort((ends[:, 1], edge_distances, ends[:, 0]))
+    firsts = order[np.r_[True, ends[order[1:], 0] != ends[order[:-1], 0]]] if len(order) else order
+    nearest = np.full(n, -1, dtype=np.int64)
+    nearest_dist = np.full(n, np.inf)
+    nearest[ends[firsts, 0]] = ends[firsts, 1]
+    nearest_dist[ends[firsts, 0]] = edge_distances[firsts]
+
+    heap = [(distance, region) for region, distance in enumerate(nearest_dist.tolist()) if distance < np.inf]
+    heapq.heapify(heap)
+
+    merges = []
+    remaining = n
+    while remaining > clusters and heap:
+        distance, first = heapq.heappop(heap)
+        if distance != nearest_dist[first]:
+            continue   # stale entry (or merged away)
+        second = int(nearest[first])
+        if (n - remaining) % 1024 == 0:
+            checkpoint(token, (n - remaining) / max(n - clusters, 1))
+
+        # The region with more neighbours is kept (fewer neighbour lists to rewrite)
+        kept, merged = (first, second) if len(neighbours[first]) >= len(neighbours[second]) else (second, first)
+        total = sizes[kept] + sizes[merged]
+        centroids[kept] = (centroids[kept] * sizes[kept] + centroids[merged] * sizes[merged]) / total
+        sizes[kept] = total
+        nearest[merged], nearest_dist[merged] = -2, np.inf
+        merges.append((kept, merged, distance))
+        remaining -= 1
+
+        for neighbour in neighbours[merged]:
+            neighbours[neighbour].discard(merged)
+            if neighbour != kept:
+                neighbours[neighbour].add(kept)
+        neighbours[kept] |= neighbours[merged]
+        neighbours[kept].discard(kept)
+        neighbours[kept].discard(merged)
+        neighbours[merged] = set()
+
+        around = np.fromiter(neighbours[kept], dtype=np.int64, count=len(neighbours[kept]))
+        if not around.size:
+            nearest[kept], nearest_dist[kept] = -1, np.inf
             continue
+        dist = distances_to(kept, around)
+        nearest[kept] = around[np.argmin(dist)]
+        nearest_dist[kept] = dist.min()
+        heapq.heappush(heap, (float(nearest_dist[kept]), kept))
 
-        # Merge j into i
-        clusters[i] += clusters[j]
-        del clusters[j]
+        # Neighbours now closer to the merged region, and neighbours whose nearest neighbour moved away or disappeared
+        closer = dist < nearest_dist[around]
+        lost = ~closer & (((nearest[around] == kept) & (dist > nearest_dist[around])) | (nearest[around] == merged))
+        nearest[around[closer]] = kept
+        nearest_dist[around[closer]] = dist[closer]
+        for entry in zip(dist[closer].tolist(), around[closer].tolist()):
+            heapq.heappush(heap, entry)
+        for region in around[lost].tolist():
+            candidates = np.fromiter(neighbours[region], dtype=np.int64, count=len(neighbours[region]))
+            candidate_dist = distances_to(region, candidates)
+            nearest[region] = candidates[np.argmin(candidate_dist)]
+            nearest_dist[region] = candidate_dist.min()
+            heapq.heappush(heap, (float(nearest_dist[region]), region))
 
-        # Update centroid of merged cluster
-        centroids[i] = np.mean(img_data[clusters[i]], axis=0)
-        del centroids[j]
+    return merges
 
-        # Update distances only for i
-        for m in clusters.keys():
-            if m != i:
-                dist = np.linalg.norm(centroids[i] - centroids[m])
-                distances[i, m] = distances[m, i] = dist
 
-        distances[j, :] = np.inf
-        distances[:, j] = np.inf
+def _merged_labels(merges, count, item_of_pixel):
+    """
+     Labels of the pixels once count items are merged : every item follows its merges (kept, merged, _) up to the
+     surviving one, labels numbered in order of first appearance (int32).
+    """
+    parent = np.arange(count)
+    merges = np.asarray(merges).reshape(-1, 3)
+    parent[merges[:, 1].astype(np.int64)] = merges[:, 0].astype(np.int64)   # every item is merged away once
+    while np.any(parent[parent] != parent):
+        parent = parent[parent]
+    _, first, labels = np.unique(parent[item_of_pixel], return_index=True, return_inverse=True)
+    return np.argsort(np.argsort(first))[labels.ravel()].astype(np.int32)
 
-    # Build final labels
-    labels = np.zeros(num_pixels, dtype=np.int32)
-    for label, cluster in enumerate(clusters.values()):
-        for pixel_idx in cluster:
-            labels[pixel_idx] = label
 
-    segmented_img = labels.reshape((image.shape[0], image.shape[1]))
+def _centroid_linkage(points, weights, clusters=1, dense_below=4096, token=None, preview=None):
+    """
+     Centroid linkage (distance between size weighted centroids) of weighted points, merged until `clusters` remain.
+     Every cluster keeps its nearest neighbour, and a heap holds (distance to it, cluster) : the top valid entry is
+     the closest pair. While more than dense_below clusters remain, a merge only looks at the clusters within reach
+     of the merged one (see _sweep_linkage), then at all of them in dense arrays (see _dense_linkage), from the start
+     for fewer than twice dense_below points (setting the sweep up would cost more).
+     Memory is linear in the number of points.
+     Returns the merges in order : (kept, merged, distance) as point indices, the merged cluster keeps the id kept.
+     token : optional CancellationToken, checked (with the fraction of merges done) every 1024 merges,
+             given preview(merges so far) as intermediate result when preview is set
+    """
+    n = len(points)
+    centroids = points.astype(np.float64)
+    sizes = np.asarray(weights, dtype=np.float64).tolist()
+    merges = []
 
-    return segmented_img
+    def progress():
+        checkpoint(token, len(merges) / max(n - clusters, 1), preview and (lambda: preview(merges)))
+
+    # Step 1: Nearest neighbours of the integer points (exact lattice lookup), the others are looked for by the merging
+    nearest, nearest_dist = _lattice_nearest(points)
+
+    # Step 2: Merge the closest pair, looking at the clusters within reach, then at all of them
+    clusters_left = np.arange(n)
+    if n > max(clusters, 2 * dense_below):
+        clusters_left, nearest, nearest_dist = _sweep_linkage(centroids, sizes, nearest, nearest_dist, merges,
+                                                              max(clusters, dense_below), progress)
+    _dense_linkage(centroids, sizes, clusters_left, nearest, nearest_dist, merges, clusters, progress)
+    return merges
+
+
+def _sweep_linkage(centroids, sizes, lattice, lattice_dist, merges, stop, progress, refresh_every=64, resort_every=16):
+    """
+     Centroid linkage of the points (centroids and sizes, updated in place) until stop clusters remain, merges
+     appended to merges (progress() called every 1024), lattice / lattice_dist : known nearest neighbours (-1 : none).
+     After a merge only the clusters within reach are looked at, found by a sweep : the clusters are sorted by
+     bands of their coordinate along the second main axis of the points, then along the first one, so the clusters
+     closer than d to a point are in a few slices (of the bands within d of it, within d of it along the first axis).
+     The clusters that can move to the merged one (closer to it than to their nearest neighbour) are found likewise,
+     grouped in levels by the distance to their nearest neighbour (up to quantiles of it, bands twice as wide).
+     The clusters moved (or further from their nearest neighbour than their level) are looked at one by one until
+     refresh_every of them are put back in place (the levels are set again every resort_every times).
+     The clusters whose nearest neighbour took part in the merge keep their distance as a lower bound and
+     are looked at again once it comes first in the heap.
+     Returns the clusters left (point indices), their nearest neighbours (-1 : to look for) and squared distances.
+    """
+    n, channels = centroids.shape
+    alive = np.ones(n, dtype=bool)
+    # per cluster : nearest cluster (-1 : to look for again, nearest_dist is then a lower bound of its distance),
+    # its squared distance, the clusters it is the nearest of
+    nearest = [-1] * n
+    nearest_dist = np.full(n, np.inf)
+    followers = [set() for _ in range(n)]
+    heap = []
+
+    # Sweep : coordinates of every cluster along the two main axes (within [0, span] : centroids stay in the hull),
+    # sorted by key group * stride + span + first coordinate, a group being a band of the second coordinate
+    # (of a level), and the clusters not at their place since the last sort
+    centred = centroids - centroids.mean(axis=0)
+    axes = np.zeros((channels, 2))
+    axes[:, :min(channels, 2)] = np.linalg.eigh(centred.T @ centred)[1][:, ::-1][:, :2]
+    coordinates = centroids @ axes
+    origin = coordinates.min(axis=0)
+    coordinates -= origin
+    span = float(coordinates.max()) + 1.0
+    stride = 3 * span
+    level_quantiles = [0.5, 0.75, 0.9, 0.97, 0.995]
+    level_count = len(level_quantiles) + 1
+    level = np.full(n, level_count - 1)
+    level_reach = [0.0] * (level_count - 1) + [np.inf]   # squared reach of every level, the last one unbounded
+    in_sweep = np.zeros(n, dtype=bool)
+    moved = np.empty(refresh_every + 4, dtype=np.intp)
+    sweep = {"moved": 0, "refreshes": 0}
+    far_away = 1e100
+
+    def keys_of(structure, slots, levels):
+        groups = structure["firsts"][levels] + np.floor(coordinates[slots, 1] / structure["band_widths"][levels]) + 1
+        return groups * stride + span + coordinates[slots, 0]
+
+    def sort(live, levels, band_widths):
+        # live clusters sorted in levels of bands, (level, first band, band width, band count) of every level
+        band_counts = [int(span // width) + 1 for width in band_widths]
+        firsts = np.cumsum([0] + [count + 2 for count in band_counts[:-1]])
+        structure = {"firsts": firsts, "band_widths": np.array(band_widths),
+                     "bands": list(zip(range(len(band_widths)), firsts.tolist(), band_widths, band_counts))}
+        keys = keys_of(structure, live, levels)
+        order = np.argsort(keys, kind="stable")
+        structure["keys"], structure["slots"] = keys[order], live[order]
+        return structure
+
+    def refresh():
+        # the moved clusters back in place (in the level of their distance now), without the merged ones
+        if sweep["refreshes"] == resort_every:
+            return resort()
+        slots = np.unique(moved[:sweep["moved"]])
+        slots = slots[alive[slots]]
+        level[slots] = np.searchsorted(sweep["reaches"], np.sqrt(nearest_dist[slots]))
+        for structure, levels in ((sweep["reach"], level[slots]), (sweep["near"], np.zeros(len(slots), dtype=np.intp))):
+            in_place = in_sweep[structure["slots"]]
+            keys, placed = structure["keys"][in_place], structure["slots"][in_place]
+            new_keys = keys_of(structure, slots, levels)
+            order = np.argsort(new_keys)
+            at = np.searchsorted(keys, new_keys[order])
+            structure["keys"] = np.insert(keys, at, new_keys[order])
+            structure["slots"] = np.insert(placed, at, slots[order])
+        in_sweep[slots] = True
+        sweep["moved"] = 0
+        sweep["refreshes"] += 1
+
+    def resort():
+        live = np.flatnonzero(alive)
+        # levels : reach up to quantiles of the distances to the nearest neighbour, the last level holding the rest
+        # (and the unknown ones)
+        finite = nearest_dist[live][np.isfinite(nearest_dist[live])]
+        reaches = np.sqrt(np.quantile(finite, level_quantiles)) if finite.size else np.ones(level_count - 1)
+        reaches = np.maximum(reaches, 1e-6)
+        level_reach[:-1] = (reaches ** 2).tolist()
+        level[live] = np.searchsorted(reaches, np.sqrt(nearest_dist[live]))
+        sweep["reaches"] = reaches
+        sweep["widths"] = (reaches * (1 + 1e-6) + 1e-6).tolist() + [span]
+        sweep["reach"] = sort(live, level[live], [2 * width for width in sweep["widths"]])
+        sweep["near"] = sort(live, np.zeros(len(live), dtype=np.intp), [2 * sweep["widths"][0]])
+        in_sweep[:] = alive
+        sweep["moved"] = sweep["refreshes"] = 0
+
+    def mark_moved(point):
+        in_sweep[point] = False
+        moved[sweep["moved"]] = point
+        sweep["moved"] += 1
+
+    def around(point, widths, structure):
+        # clusters (a superset) within widths (by level) of point along both axes
+        # (the slices may hold moved clusters, whose centroid is up to date, and merged ones, far away)
+        first_coordinate, second_coordinate = coordinates[point].tolist()
+        bounds = []
+        for index, first_band, band_width, band_count in structure["bands"]:
+            width = min(widths[index], span)
+            low = max(int((second_coordinate - width) // band_width) + 1, 1)
+            high = min(int((second_coordinate + width) // band_width) + 1, band_count)
+            for group in range(first_band + low, first_band + high + 1):
+                key = group * stride + span + first_coordinate
+                bounds += (key - width, key + width)
+        bounds = np.searchsorted(structure["keys"], bounds).tolist()
+        slots = structure["slots"]
+        slots = [slots[bounds[i]:bounds[i + 1]] for i in range(0, len(bounds), 2)]
+        if sweep["moved"]:
+            slots.append(moved[:sweep["moved"]])
+        return np.concatenate(slots)
+
+    def closest(point, candidates, dist):
+        # lowest squared distance to point, ties to the lowest index
+        dist[candidates == point] = np.inf
+        best = dist.min(initial=np.inf)
+        if best == np.inf:
+            return -1, np.inf
+        return int(candidates[dist == best].min()), float(best)
+
+    def find_nearest(point, half_width):
+        # every cluster outside the slices is further than half_width : widened to the closest one found until then
+        while True:
+            candidates = around(point, [half_width], sweep["near"])
+            other, dist = closest(point, candidates, ((centroids[candidates] - centroids[point]) ** 2).sum(axis=1))
+            if dist < half_width * half_width or half_width >= span:
+                return other, dist
+            half_width = 2 * half_width if dist == np.inf else math.sqrt(dist) * (1 + 1e-6) + 1e-6
+
+    def set_nearest(point, other, dist):
+        if nearest[point] >= 0:
+            followers[nearest[point]].discard(point)
+        nearest[point] = other
+        nearest_dist[point] = dist
+        followers[other].add(point)
+        if dist > level_reach[level[point]] and in_sweep[point]:
+            mark_moved(point)   # out of reach of its level
+        heapq.heappush(heap, (dist, point))
+
+    # Step 1: Nearest neighbour of every point (from the lattice, or looked for)
+    resort()
+    for point in range(n):
+        if lattice[point] >= 0:
+            set_nearest(point, int(lattice[point]), float(lattice_dist[point]))
+        elif n > 1:
+            set_nearest(point, *find_nearest(point, 1.0))
+    resort()
+
+    # Step 2: Merge the closest pair, update the nearest neighbours
+    remaining = n
+    while remaining > stop and heap:
+        if sweep["moved"] >= refresh_every:
+            refresh()
+        distance, kept = heapq.heappop(heap)   # (plain floats : numpy scalars make every heap comparison slow)
+        if distance != nearest_dist[kept] or not alive[kept]:
+            continue   # stale entry
+        if nearest[kept] < 0:
+            # its lower bound came first : look now (the nearest neighbour is then most often a little further)
+            set_nearest(kept, *find_nearest(kept, 1.35 * math.sqrt(distance)))
+            continue
+        if len(merges) % 1024 == 0:
+            progress()
+        merged = nearest[kept]
+
+        kept_size, merged_size = sizes[kept], sizes[merged]
+        total = sizes[kept] = kept_size + merged_size
+        centroids[kept] = [(kept_value * kept_size + merged_value * merged_size) / total
+                           for kept_value, merged_value in zip(centroids[kept].tolist(), centroids[merged].tolist())]
+        coordinates[kept] = centroids[kept] @ axes - origin
+        if in_sweep[kept]:
+            mark_moved(kept)
+        alive[merged] = in_sweep[merged] = False
+        centroids[merged] = far_away   # never the closest, nor closer than a nearest neighbour
+        nearest_dist[merged] = -np.inf
+        followers[nearest[merged]].discard(merged)   # (kept leaves the followers of merged in set_nearest)
+        merges.append((kept, merged, math.sqrt(distance)))
+        remaining -= 1
+        if remaining == 1:
+            break
+
+        # Nearest neighbour of the merged cluster (most often within twice the merge distance), and the clusters
+        # now closer to it than to their nearest neighbour
+        half_width = 2 * math.sqrt(distance)
+        candidates = around(kept, [max(width, half_width) for width in sweep["widths"]], sweep["reach"])
+        dist = ((centroids[candidates] - centroids[kept]) ** 2).sum(axis=1)
+        other, other_dist = closest(kept, candidates, dist)
+        half_width = max(half_width, sweep["widths"][0])   # every level looked at within that
+        if not other_dist < half_width * half_width:
+            other, other_dist = find_nearest(kept, math.sqrt(other_dist) * (1 + 1e-6) + 1e-6)
+        set_nearest(kept, other, other_dist)
+        closer = dist < nearest_dist[candidates]
+        for point, point_dist in dict(zip(candidates[closer].tolist(), dist[closer].tolist())).items():
+            set_nearest(point, kept, point_dist)
+
+        # Clusters whose nearest neighbour moved away or disappeared : every other cluster is still at least as far
+        # as it was, so that distance (and its heap entry) is a lower bound, looked at again once it comes first
+        lost = followers[merged] | {point for point in followers[kept]
+                                    if ((centroids[point] - centroids[kept]) ** 2).sum() > nearest_dist[point]}
+        lost.discard(kept)
+        for point in lost:
+            nearest[point] = -1
+        followers[merged].clear()
+        followers[kept] -= lost
+
+    left = np.flatnonzero(alive)
+    return left, np.array(nearest)[left], nearest_dist[left]
+
+
+def _dense_linkage(centroids, sizes, ids, nearest, nearest_dist, merges, clusters, progress, chunk_size=256):
+    """
+     Centroid linkage of the clusters ids (point indices, ascending) until `clusters` remain, merges appended to merges
+     (progress() called every 1024), centroids and sizes by point index, nearest / nearest_dist : their nearest
+     neighbour (point index, -1 : to look for) and squared distance.
+     The clusters are held in dense arrays : after a merge the merged cluster is compared to every other one, those
+     whose nearest neighbour took part in it are rescanned (all at once), the arrays are compacted whenever half
+     of their slots are merged away.
+    """
+    slot = np.full(len(centroids), -1)
+    slot[ids] = np.arange(len(ids))
+    centroids = centroids[ids].T.copy()   # channels x slots, merged away slots far away : never the nearest
+    sizes = np.asarray(sizes)[ids]
+    nearest = np.where(nearest >= 0, slot[nearest], -1)
+    nearest_dist = np.asarray(nearest_dist, dtype=np.float64).copy()
+
+    def squared_distances(rows):
+        # of the given slots to every slot (itself excluded)
+        difference = centroids[:, None, :] - centroids[:, rows, None]
+        difference *= difference
+        dist = difference.sum(axis=0)
+        dist[np.arange(len(rows)), rows] = np.inf
+        return dist
+
+    # Step 1: Nearest neighbour of every cluster not known yet, chunks of rows
+    unknown = np.flatnonzero(nearest < 0)
+    for start in range(0, len(unknown), chunk_size):
+        rows = unknown[start:start + chunk_size]
+        dist = squared_distances(rows)
+        nearest[rows] = np.argmin(dist, axis=1)
+        nearest_dist[rows] = dist[np.arange(len(rows)), nearest[rows]]
+
+    heap = list(zip(nearest_dist.tolist(), range(len(ids))))
+    heapq.heapify(heap)
+
+    # Step 2: Merge the closest pair, update the nearest neighbours
+    remaining = len(ids)
+    while remaining > clusters and heap:
+        distance, kept = heapq.heappop(heap)   # (plain floats : numpy scalars make every heap comparison slow)
+        if distance != nearest_dist[kept] or nearest[kept] < 0:
+            continue   # stale entry
+        if len(merges) % 1024 == 0:
+            progress()
+        merged = nearest[kept]
+
+        total = sizes[kept] + sizes[merged]
+        centroids[:, kept] = (centroids[:, kept] * sizes[kept] + centroids[:, merged] * sizes[merged]) / total
+        sizes[kept] = total
+        centroids[:, merged] = 1e100
+        nearest[merged], nearest_dist[merged] = -2, -np.inf
+        merges.append((int(ids[kept]), int(ids[merged]), math.sqrt(distance)))
+        remaining -= 1
+        if remaining == 1:
+            break
+
+        if 2 * remaining < len(ids):
+            # Compact the slots (renumbering the nearest neighbours) and rebuild the heap
+            keep = np.flatnonzero(nearest != -2)
+            slot = np.full(len(ids), -1)
+            slot[keep] = np.arange(len(keep))
+            centroids, sizes, ids = centroids[:, keep].copy(), sizes[keep], ids[keep]
+            nearest, nearest_dist = slot[nearest[keep]], nearest_dist[keep]
+            kept = slot[kept]
+            merged = -1
+            heap = list(zip(nearest_dist.tolist(), range(len(ids))))
+            heapq.heapify(heap)
+
+        dist = squared_distances(np.array([kept]))[0]
+        nearest[kept] = np.argmin(dist)
+        nearest_dist[kept] = dist[nearest[kept]]
+        heapq.heappush(heap, (float(nearest_dist[kept]), kept))
+
+        # Clusters now closer to the merged cluster than to their nearest neighbour
+        closer = np.flatnonzero(dist < nearest_dist)
+        nearest[closer] = kept
+        nearest_dist[closer] = dist[closer]
+        for entry in zip(dist[closer].tolist(), closer.tolist()):
+            heapq.heappush(heap, entry)
+
+        # Clusters whose nearest neighbour moved away or disappeared
+        lost = np.flatnonzero(((nearest == kept) & (dist > nearest_dist)) | (nearest == merged))
+        lost = lost[lost != kept]
+        if lost.size:
+            lost_dist = squared_distances(lost)
+            nearest[lost] = np.argmin(lost_dist, axis=1)
+            nearest_dist[lost] = lost_dist[np.arange(lost.size), nearest[lost]]
+            for entry in zip(nearest_dist[lost].tolist(), lost.tolist()):
+                heapq.heappush(heap, entry)
+
+
+def _lattice_nearest(points, max_squared_distance=4):
+    """
+     Nearest neighbour of distinct integer points (e.g. unique colours) found by looking up the lattice offsets
+     of squared length 1, 2 .. max_squared_distance (a point found at the shortest one is the nearest, ties go to
+     the lowest index). Returns the nearest index and squared distance of every point, -1 / inf when none is that close.
+    """
+    n, channels = points.shape
+    nearest = np.full(n, -1, dtype=np.int64)
+    nearest_dist = np.full(n, np.inf)
+    if not n or np.any(points != np.round(points)):
+        return nearest, nearest_dist
+
+    reach = int(np.sqrt(max_squared_distance))
+    base = int(points.max() - points.min()) + 2 * reach + 1
+    packed = ((points - points.min() + reach).astype(np.int64) * base ** np.arange(channels)).sum(axis=1)
+    order = np.argsort(packed)
+    sorted_keys = packed[order]
+
+    offsets = np.stack(np.meshgrid(*[np.arange(-reach, reach + 1)] * channels, indexing="ij"), axis=-1).reshape(-1, channels)
+    lengths = (offsets ** 2).sum(axis=1)
+    for length in range(1, max_squared_distance + 1):
+        pending = np.flatnonzero(nearest < 0)
+        if not pending.size:
+            break
+        found = np.full(pending.size, n)
+        for offset in offsets[lengths == length]:
+            keys = packed[pending] + int((offset * base ** np.arange(channels)).sum())
+            at = np.searchsorted(sorted_keys, keys).clip(max=n - 1)
+            hit = sorted_keys[at] == keys
+            found[hit] = np.minimum(found[hit], order[at[hit]])
+        resolved = found < n
+        nearest[pending[resolved]] = found[resolved]
+        nearest_dist[pending[resolved]] = length
+    return nearest, nearest_dist
@@ -1,21 +1,25 @@
 import numpy as np
+import cv2
 
 
 class Thresholding:
+    # window methods of adaptive_thresholding, also accepted by local_thresholding in place of a block method
+    ADAPTIVE_METHODS = ("mean", "niblack", "sauvola")
+
     @staticmethod
-    def spectral_thresholding(image):
+    def spectral_thresholding(image, prominence=0, min_distance=1):
+        # prominence   : minimum height of a peak above the highest of its 2 bases (in smoothed pixel counts)
+        # min_distance : minimum distance in intensity levels between 2 peaks, the highest peak is kept
         # Step 1: Build histogram 
-        hist, _ = np.histogram(image, bins=256, range=(0, 256))
+        hist = np.bincount(image.ravel(), minlength=256)
 
         # Step 2: Smooth histogram  (simple moving average)
         window_size = 5
         hist_smooth = np.convolve(hist, np.ones(window_size) / window_size, mode='same')
 
-        # Step 3: Find peaks 
-        peaks = []
-        for i in range(1, len(hist_smooth) - 1):
-            if hist_smooth[i] > hist_smooth[i - 1] and hist_smooth[i] > hist_smooth[i + 1]:
-                peaks.append(i)
+        # Step 3: Find peaks (strict local maxima, all compared at once)
+        peaks = np.flatnonzero((hist_smooth[1:-1] > hist_smooth[:-2]) & (hist_smooth[1:-1] > hist_smooth[2:])) + 1
+        peaks = Thresholding.filter_peaks(hist_smooth, peaks, prominence, min_distance)
 
         # Step 4: Safety check
         if len(peaks) < 2:
@@ -24,118 +28,70 @@ class Thresholding:
             return segmented
 
         # Step 5: Set thresholds
-        thresholds = []
-        for i in range(len(peaks) - 1):
-            midpoint = (peaks[i] + peaks[i + 1]) // 2
-            thresholds.append(midpoint)
-
-        # Step 6: Apply thresholding 
-        segmented = np.zeros_like(image)
-
-        if len(thresholds) == 1:
-            t1 = thresholds[0]
-            segmented[image <= t1] = 0
-            segmented[image > t1] = 255
-
-        elif len(thresholds) == 2:
-            t1, t2 = thresholds
-            segmented[image <= t1] = 0
-            segmented[(image > t1) & (image <= t2)] = 127
-            segmented[image > t2] = 255
-
-        else:
-            values = np.linspace(0, 255, len(thresholds) + 1, dtype=np.uint8)
-            prev_thresh = 0
-            for i, t in enumerate(thresholds):
-                segmented[(image > prev_thresh) & (image <= t)] = values[i]
-                prev_thresh = t
-            segmented[image > thresholds[-1]] = values[-1]
+        thresholds = (peaks[:-1] + peaks[1:]) // 2
+
+        # Step 6: Apply thresholding : class i holds the intensities in (thresholds[i - 1], thresholds[i]],
+        # evenly spread grey levels (0 / 255, 0 / 127 / 255, ...) in a 256 entries lookup table, applied in one pass
+        values = np.linspace(0, 255, len(thresholds) + 1, dtype=np.uint8)
+        lookup = values[np.searchsorted(thresholds, np.arange(256), side='left')].astype(image.dtype)
+        segmented = lookup[image]
 
         return segmented
 
+    @staticmethod
+    def filter_peaks(histogram, peaks, prominence=0, min_distance=1):
+        # Step 1: prominence : on each side the base is the lowest bin between the peak and the first strictly
+        # higher bin (or the histogram end), the peak is kept if it stands at least prominence above the higher base
+        if prominence > 0 and len(peaks):
+            bins = np.arange(len(histogram))
+            heights = histogram[peaks][:, None]
+            higher = histogram[None, :] > heights
+            left = np.where(higher & (bins < peaks[:, None]), bins, -1).max(axis=1)
+            right = np.where(higher & (bins > peaks[:, None]), bins, len(histogram)).min(axis=1)
+            left_base = np.where((bins > left[:, None]) & (bins <= peaks[:, None]), histogram, np.inf).min(axis=1)
+            right_base = np.where((bins >= peaks[:, None]) & (bins < right[:, None]), histogram, np.inf).min(axis=1)
+            peaks = peaks[histogram[peaks] - np.maximum(left_base, right_base) >= prominence]
+
+        # Step 2: minimum distance : greedy from the highest peak (the rightmost first among equal ones), every kept
+        # peak drops the peaks closer than min_distance to it, a dropped peak drops nothing
+        if min_distance > 1 and len(peaks) > 1:
+            keep = np.ones(len(peaks), dtype=bool)
+            for i in np.argsort(histogram[peaks], kind='stable')[::-1]:
+                if keep[i]:
+                    close = np.abs(peaks - peaks[i]) < min_distance
+                    close[i] = False
+                    keep[close] = False
+            peaks = peaks[keep]
+        return peaks
+
     @staticmethod
     def optimal_thresholding(block):
-        # get image dimensions and initialize output
+        # Iterative selection on the 256 bins histogram of the block (see optimal_thresholds) :
+        # Step 1: the 4 corner pixels are the initial background, every other pixel the initial object
+        # Step 2: the threshold is found from the cumulative moments of the histogram, without touching the pixels
+        # Step 3: the threshold is applied with a single lookup table
         height, width = block.shape
-        output_block = block.copy()
-
-        # create object and background masks to divide pixels into 2 arrays
-        bg_mask = np.zeros_like(block, dtype=bool)
-        bg_mask[0, 0] = True
-        bg_mask[height - 1, 0] = True
-        bg_mask[0, width - 1] = True
-        bg_mask[height - 1, width - 1] = True
-        obj_mask = ~bg_mask
-
-        # parameter to keep track of iterations
-        new_threshold=0
-   
-        for i in range(20):
-
-            # update the thresholds
-            previous_threshold=new_threshold
-
-            # use the masks to extract object and background pixels
-            obj_pixels = output_block[obj_mask]
-            bg_pixels = output_block[bg_mask]
-
-            # find mean of bg and obj pixel values
-            obj_mean = np.mean(obj_pixels)
-            bg_mean = np.mean(bg_pixels)
+        corners = np.unique([0, (width - 1), (height - 1) * width, (height - 1) * width + width - 1])
+        histogram = np.bincount(block.ravel(), minlength=256)
+        threshold = Thresholding.optimal_thresholds(histogram, block.ravel()[corners].sum(dtype=np.float64),
+                                                    len(corners))[0]
 
-            # compute threshold (T) as their avg bg+obj/2  (avg of means)
-            new_threshold = (obj_mean + bg_mean) / 2
-
-            # redefine the masks to separate object and background pixels using new threshold
-            obj_mask = output_block > new_threshold
-            bg_mask = output_block <= new_threshold
-
-            # if threshold value stops changing, end the loop
-            if (np.abs(previous_threshold-new_threshold)<2):
-                break
-
-        # finally threshold the image using the optimally computed threshold
-        output_block[block >= new_threshold] = 255  
-        output_block[block < new_threshold] = 0   
-
-        return output_block
+        # pixels >= threshold -> 255, < threshold -> 0 (no threshold, nan, when a class empties : block unchanged)
+        if np.isnan(threshold):
+            return block.copy()
+        lookup = np.where(np.arange(256) >= threshold, 255, 0).astype(block.dtype)
+        return lookup[block]
 
+    @staticmethod
     def otsu_thresholding(block):
-        # initalize variance array and output block
-        variances = np.zeros(256)
+        # initalize output block
         output_block = block.copy()
 
         # GET histogram, indexed from 0-->255 and values are the frequencies
         histogram, bin_edges = np.histogram(output_block, bins=256, range=(0, 256))
-        total_pixels = np.sum(histogram)  
-
-        # Loop over all intensity values (0-->255), each time dividing the histograms into 2 classes at intensity i 
-        for i in range (0,256):
-
-            # compute weights of the 2 classes:
-            obj_weight = np.sum(histogram[i:256]) / total_pixels
-            bg_weight = np.sum(histogram[0:i]) / total_pixels
-           
-            # compute mean of the 2 classes:
-            obj_intensities = np.sum(histogram[i:256])
-            bg_intensities = np.sum(histogram[0:i])
-
-            # ensure no division by zero
-            if obj_intensities != 0:
-                obj_mean = np.sum(np.arange(i, 256) * histogram[i:256]) / obj_intensities
-            else:
-                obj_mean = 0
-
-            if bg_intensities != 0:
-                bg_mean = np.sum(np.arange(0, i) * histogram[0:i]) / bg_intensities
-            else:
-                bg_mean = 0
-
-            # compute variance using the weights and means
-            variances[i]=obj_weight*bg_weight*((obj_mean-bg_mean)**2)
 
-        # Find the index of the maximun variance, this is my intensity threshold value 
-        otsu_threshold=np.argmax(variances)
+        # Find the intensity of maximum between-class variance, this is my intensity threshold value
+        otsu_threshold = Thresholding.otsu_threshold(histogram)
 
         # threshold the image based on the otsu threshold computed
         output_block[block>=otsu_threshold]=255
@@ -143,12 +99,121 @@ class Thresholding:
 
         return output_block
 
+    @staticmethod
+    def otsu_threshold(histogram):
+        # Every threshold i divides the histogram into 2 classes : background [0, i) and object [i, 256)
+        # prefix sums give the pixel count and intensity sum of the background for all i at once.
+        # histogram : 256 bins, or (tiles, 256) for one threshold per tile
+        histogram = np.asarray(histogram, dtype=np.float64)
+        weighted = np.arange(256) * histogram
+        bg_intensities = np.cumsum(histogram, axis=-1)
+        bg_sums = np.cumsum(weighted, axis=-1)
+        total_pixels = bg_intensities[..., -1:].copy()
+        obj_intensities = total_pixels - bg_intensities
+        obj_sums = bg_sums[..., -1:] - bg_sums
+        obj_intensities += histogram
+        obj_sums += weighted
+        bg_intensities -= histogram
+        bg_sums -= weighted
+
+        # compute weights and means of the 2 classes (mean 0 for an empty class)
+        bg_mean = np.divide(bg_sums, bg_intensities, out=np.zeros_like(bg_sums), where=bg_intensities != 0)
+        obj_mean = np.divide(obj_sums, obj_intensities, out=np.zeros_like(obj_sums), where=obj_intensities != 0)
+        bg_weight = np.divide(bg_intensities, total_pixels, out=bg_intensities)
+        obj_weight = np.divide(obj_intensities, total_pixels, out=obj_intensities)
+
+        # compute all variances using the weights and means, keep the first maximum
+        obj_mean -= bg_mean
+        variances = obj_weight * bg_weight * np.square(obj_mean, out=obj_mean)
+        thresholds = np.argmax(variances, axis=-1)
+        return int(thresholds) if thresholds.ndim == 0 else thresholds
+
+    @staticmethod
+    def optimal_thresholds(histograms, bg_sums, bg_counts, iterations=20, tolerance=2):
+        # Iterative selection on (tiles, 256) histograms, all tiles at once : starting from the given background
+        # (intensity sum, pixel count) and the rest as object, the threshold is the average of the 2 class means,
+        # pixels <= threshold become the background, until the threshold moves by less than tolerance.
+        # Class counts / sums come from the cumulative moments. An empty class gives a nan mean (and threshold).
+        histograms = np.atleast_2d(histograms).astype(np.float64)
+        rows = np.arange(len(histograms))
+        zeros = np.zeros((len(histograms), 1))
+        counts = np.concatenate((zeros, np.cumsum(histograms, axis=1)), axis=1)
+        sums = np.concatenate((zeros, np.cumsum(np.arange(256) * histograms, axis=1)), axis=1)
+        total_counts, total_sums = counts[:, -1], sums[:, -1]
+
+        threshold = np.zeros(len(histograms))
+        active = np.ones(len(histograms), dtype=bool)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            bg_counts = np.asarray(bg_counts, dtype=np.float64)
+            bg_sums = np.asarray(bg_sums, dtype=np.float64)
+            obj_counts, obj_sums = total_counts - bg_counts, total_sums - bg_sums
+            for i in range(iterations):
+                previous_threshold = threshold
+                threshold = np.where(active, (obj_sums / obj_counts + bg_sums / bg_counts) / 2, threshold)
+
+                # background : intensities <= threshold (nothing on either side of a nan threshold)
+                unknown = np.isnan(threshold)
+                split = np.clip(np.floor(np.where(unknown, -1, threshold)) + 1, 0, 256).astype(np.int64)
+                bg_counts, bg_sums = counts[rows, split], sums[rows, split]
+                obj_counts = np.where(unknown, 0, total_counts - bg_counts)
+                obj_sums = np.where(unknown, 0, total_sums - bg_sums)
+
+                # if threshold value stops changing, that tile is done
+                active &= ~(np.abs(previous_threshold - threshold) < tolerance)
+                if not active.any():
+                    break
+        return threshold
+
+    @staticmethod
+    def multi_otsu_thresholds(image, classes=3):
+        # Thresholds t1 < t2 < .. splitting the histogram into `classes` classes ([0, t1), [t1, t2) ..) of maximum
+        # between-class variance, i.e. maximum sum over classes of (intensity sum)^2 / pixel count.
+        # Dynamic programming over the cumulative moments : best[c][b] = best split of [0, b) into c classes
+        histogram, _ = np.histogram(image, bins=256, range=(0, 256))
+        counts = np.concatenate(([0], np.cumsum(histogram))).astype(np.float64)
+        sums = np.concatenate(([0], np.cumsum(np.arange(256) * histogram))).astype(np.float64)
+
+        # score[a, b] : contribution of the class [a, b) (0 when empty or a >= b)
+        class_counts = counts[None, :] - counts[:, None]
+        class_sums = sums[None, :] - sums[:, None]
+        score = np.divide(class_sums ** 2, class_counts, out=np.zeros_like(class_counts), where=class_counts > 0)
+        score[np.tril_indices(257)] = -np.inf
+
+        best = score[0]
+        splits = []
+        for _ in range(classes - 1):
+            candidates = best[:, None] + score   # previous classes end at a, next one is [a, b)
+            splits.append(np.argmax(candidates, axis=0))
+            best = candidates.max(axis=0)
+
+        # backtrack from the last class ending at 256
+        thresholds = []
+        end = 256
+        for split in reversed(splits):
+            end = int(split[end])
+            thresholds.append(end)
+        return thresholds[::-1]
 
     @staticmethod
-    def local_thresholding(image, thresholding_method, block_size=30):
+    def multi_otsu_thresholding(image, classes=3):
+        # classes mapped to evenly spaced intensities (0 .. 255)
+        thresholds = Thresholding.multi_otsu_thresholds(image, classes)
+        values = np.linspace(0, 255, classes).astype(np.uint8)
+        return values[np.searchsorted(thresholds, image, side="right")]
+
+    @staticmethod
+    def local_thresholding(image, thresholding_method, block_size=30, interpolate=False):
+        # Window methods ("mean", "niblack", "sauvola") : a threshold per pixel from the block_size window around it
+        if isinstance(thresholding_method, str):
+            return Thresholding.adaptive_thresholding(image, block_size | 1, thresholding_method)
+
+        # Otsu and optimal thresholds of all the blocks are computed at once from their histograms
+        if thresholding_method in (Thresholding.otsu_thresholding, Thresholding.optimal_thresholding):
+            return Thresholding.batched_local_thresholding(image, thresholding_method, block_size, interpolate)
+
         # initialize output image and get dimensions
         height, width = image.shape
-        output_image = np.zeros_like(image, dtype=np.int8)
+        output_image = np.zeros_like(image, dtype=np.uint8)
 
         for i in range(0, height, block_size):
             for j in range(0, width, block_size):
@@ -161,3 +226,122 @@ class Thresholding:
 
         return output_image
     
+
+    @staticmethod
+    def batched_local_thresholding(image, thresholding_method, block_size=30, interpolate=False, band_bins=1 << 20):
+        # Local Otsu / optimal thresholding without a per block loop, one band of block rows at a time
+        # (at most band_bins histogram bins, so small blocks don't need a 256 bins histogram per pixel in memory) :
+        # Step 1: the histograms of all blocks of the band in one bincount, key = block * 256 + intensity
+        # Step 2: all their thresholds solved at once (same thresholds as the per block methods)
+        # Step 3: applied with a (blocks, 256) lookup table indexed by the same keys, or with interpolate,
+        #         bilinearly interpolated between block centres (no block borders) and compared per pixel
+        height, width = image.shape
+        blocks_y, blocks_x = -(-height // block_size), -(-width // block_size)
+        band_blocks = max(1, band_bins // (blocks_x * 256))
+        col_keys = (np.arange(width, dtype=np.int32) // block_size) * 256
+        left = np.arange(blocks_x) * block_size
+        right = np.minimum(left + block_size, width) - 1
+        wide = (right > left)[None, :]
+
+        thresholds = np.empty((blocks_y, blocks_x))
+        output_image = np.empty_like(image, dtype=np.uint8)
+        for first_block in range(0, blocks_y, band_blocks):
+            last_block = min(first_block + band_blocks, blocks_y)
+            band = image[first_block * block_size:min(last_block * block_size, height)]
+            row_keys = (np.arange(len(band), dtype=np.int32) // block_size) * (blocks_x * 256)
+            keys = row_keys[:, None] + col_keys[None, :] + band
+            histograms = np.bincount(keys.ravel(), minlength=(last_block - first_block) * blocks_x * 256)
+            histograms = histograms.reshape(-1, 256)
+
+            if thresholding_method is Thresholding.otsu_thresholding:
+                band_thresholds = Thresholding.otsu_threshold(histograms).astype(np.float64)
+            else:
+                # initial background : the (distinct) corner pixels of every block
+                top = np.arange(last_block - first_block) * block_size
+                bottom = np.minimum(top + block_size, len(band)) - 1
+                tall = (bottom > top)[:, None]
+                bg_sums = (band[top][:, left].astype(np.float64) + wide * band[top][:, right]
+                           + tall * band[bottom][:, left] + (tall & wide) * band[bottom][:, right])
+                bg_counts = 1 + wide.astype(int) + tall + (tall & wide)
+                band_thresholds = Thresholding.optimal_thresholds(histograms, bg_sums.ravel(), bg_counts.ravel())
+            thresholds[first_block:last_block] = band_thresholds.reshape(-1, blocks_x)
+
+            if not interpolate:
+                # pixels >= threshold -> 255, a block without threshold (nan, uniform block) keeps its pixels
+                lookup = np.where(np.arange(256) >= band_thresholds[:, None], 255, 0)
+                lookup[np.isnan(band_thresholds)] = np.arange(256)
+                output_image[first_block * block_size:first_block * block_size + len(band)] = \
+                    lookup.astype(np.uint8).ravel()[keys]
+        if not interpolate:
+            return output_image
+
+        # thresholds at the block centres, bilinear in between (clamped beyond the outer centres)
+        grid = np.where(np.isnan(thresholds), np.nanmean(thresholds) if np.any(~np.isnan(thresholds)) else 128,
+                        thresholds)
+
+        def axis_weights(size, blocks):
+            starts = np.arange(blocks) * block_size
+            centres = (starts + np.minimum(starts + block_size, size) - 1) / 2
+            position = np.interp(np.arange(size), centres, np.arange(blocks))
+            lower = np.minimum(np.floor(position).astype(np.int64), blocks - 1)
+            upper = np.minimum(lower + 1, blocks - 1)
+            return lower, upper, (position - lower).astype(np.float32)
+
+        y0, y1, wy = axis_weights(height, blocks_y)
+        x0, x1, wx = axis_weights(width, blocks_x)
+        # separable : along x for every block row first (small), then along y
+        grid = grid.astype(np.float32)
+        block_rows = grid[:, x0] * (1 - wx) + grid[:, x1] * wx
+        threshold_map = block_rows[y0] * (1 - wy)[:, None]
+        threshold_map += block_rows[y1] * wy[:, None]
+        return ((image >= threshold_map) * np.uint8(255)).astype(np.uint8)
+
+    @staticmethod
+    def adaptive_thresholding(image, window_size=31, method="mean", k=None, offset=0, dynamic_range=128,
+                              band_rows=1024):
+        # Per pixel threshold from the mean m and standard deviation s of the window_size x window_size window around
+        # it (clipped at the image borders) :
+        #   "mean"    : T = m - offset
+        #   "niblack" : T = m + k * s                          (k = -0.2 by default)
+        #   "sauvola" : T = m * (1 + k * (s / dynamic_range - 1))  (k = 0.2 by default)
+        # m and s come from integral images (summed-area tables) of I and I^2 : 4 lookups per pixel whatever the
+        # window size. Rows are processed in bands of band_rows to bound the temporaries.
+        # Returns a uint8 mask (255 where the pixel is above its threshold, 0 elsewhere).
+        if method not in ("mean", "niblack", "sauvola"):
+            raise ValueError(f"Unknown local thresholding method: {method}")
+        if k is None:
+            k = -0.2 if method == "niblack" else 0.2
+
+        height, width = image.shape
+        sums, squared_sums = cv2.integral2(image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+        # window bounds of every row / column in integral image coordinates
+        radius = window_size // 2
+        top = np.clip(np.arange(height) - radius, 0, height)
+        bottom = np.clip(np.arange(height) + radius + 1, 0, height)
+        left = np.clip(np.arange(width) - radius, 0, width)
+        right = np.clip(np.arange(width) + radius + 1, 0, width)
+        counts_x = (right - left).astype(np.float64)
+
+        output_image = np.zeros((height, width), dtype=np.uint8)
+        for start in range(0, height, band_rows):
+            rows = slice(start, min(start + band_rows, height))
+            t, b = top[rows], bottom[rows]
+
+            def window_total(table):
+                column_totals = table[b] - table[t]   # sums over the window rows, per integral column
+                return column_totals[:, right] - column_totals[:, left]
+
+            counts = (b - t).astype(np.float64)[:, None] * counts_x
+            mean = window_total(sums) / counts
+            if method == "mean":
+                threshold = mean - offset
+            else:
+                deviation = np.sqrt(np.maximum(window_total(squared_sums) / counts - mean ** 2, 0))
+                if method == "niblack":
+                    threshold = mean + k * deviation
+                else:
+                    threshold = mean * (1 + k * (deviation / dynamic_range - 1))
+            output_image[rows][image[rows] > threshold] = 255
+
+        return output_image
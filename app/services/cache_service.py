@@ -0,0 +1,211 @@
+import glob
+import hashlib
+import importlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from app.utils.cancellation import checkpoint
+
+
+def image_digest(image):
+    """Content hash of an image (shape, dtype and pixels), the image part of a result cache key."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.shape}{image.dtype}".encode())
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+
+def source_version(*paths):
+    """Hash of the python sources at paths (files, or every .py of a directory) : results of older code never match."""
+    digest = hashlib.blake2b(digest_size=8)
+    for path in paths:
+        files = sorted(glob.glob(os.path.join(path, "*.py"))) if os.path.isdir(path) else [path]
+        for file in files:
+            with open(file, "rb") as source:
+                digest.update(source.read())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, memory_budget=512 << 20, cache_dir=None, disk_budget=2 << 30, version="", log=None):
+        """
+         Content addressed cache of processing results : the key of a result is a hash of
+         (image content, method, parameters, code version), so the same button on the same image is computed once.
+         memory_budget : bytes of results kept in memory, least recently used evicted first
+         cache_dir     : optional directory of a disk tier (one compressed .npz per result, survives restarts),
+                         trimmed to disk_budget bytes by last use
+         log           : optional LoggingManager, counting the hits and misses (see LoggingManager.count)
+         Results are arrays, tuples of them, None, or objects of the app (e.g. MeanShiftResult) holding arrays
+         and plain values.
+        """
+        self.memory_budget = memory_budget
+        self.cache_dir = cache_dir
+        self.disk_budget = disk_budget
+        self.version = version
+        self.log = log
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        self._entries = OrderedDict()   # key -> (result, bytes), least recently used first
+        self._memory_used = 0
+        self._lock = threading.Lock()   # looked up in the GUI thread, filled by the jobs
+        self._writer = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._writer = ThreadPoolExecutor(max_workers=1)   # compression off the job, one file at a time
+
+    def key(self, digest, method, params):
+        """Cache key of method applied with params (a repr-able tuple) to the image of digest."""
+        content = repr((digest, method, params, self.version)).encode()
+        return f"{method}-{hashlib.blake2b(content, digest_size=16).hexdigest()}"
+
+    def get(self, key):
+        """Result of key held in memory (None otherwise : the disk tier is read by compute, off the GUI thread)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+        self._count("memory_hits", key)
+        return entry[0]
+
+    def compute(self, key, function, *args, token=None, **kwargs):
+        """
+         Result of key from memory or disk, else function(*args, token=token, **kwargs) stored under key.
+         Meant to run as the job itself (e.g. JobService.submit(view, partial(cache.compute, key, function), ...)).
+        """
+        result = self.get(key)
+        if result is not None:
+            return result
+
+        result = self._load(key)
+        if result is not None:
+            checkpoint(token)
+            self._count("disk_hits", key)
+            self._remember(key, result)
+            return result
+
+        result = function(*args, token=token, **kwargs)
+        self._count("misses", key)
+        self.put(key, result)
+        return result
+
+    def put(self, key, result):
+        self._remember(key, result)
+        if self._writer is not None:
+            self._writer.submit(self._save, key, result)
+
+    def close(self):
+        """Waits for the pending disk writes."""
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+            self._writer = None
+
+    def clear(self):
+        """Empties the memory tier (the disk tier is kept)."""
+        with self._lock:
+            self._entries.clear()
+            self._memory_used = 0
+
+    def _remember(self, key, result):
+        size = sum(array.nbytes for array in _encode(result)[1].values())
+        if size > self.memory_budget:
+            return   # would evict everything, only the disk tier keeps it
+        with self._lock:
+            if key in self._entries:
+                self._memory_used -= self._entries.pop(key)[1]
+            self._entries[key] = (result, size)
+            self._memory_used += size
+            while self._memory_used > self.memory_budget:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._memory_used -= evicted
+
+    def _count(self, counter, key):
+        outcome = {"memory_hits": "hit (memory)", "disk_hits": "hit (disk)", "misses": "miss"}[counter]
+        with self._lock:   # counted from the GUI thread and the jobs
+            self.stats[counter] += 1
+            if self.log is not None:
+                self.log.count(f"result_cache_{counter}", f"Result cache {outcome} : {key}")
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def _load(self, key):
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        try:
+            with np.load(self._path(key), allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(self._path(key))   # last use, for trimming
+            return _decode(json.loads(str(arrays.pop("__layout__"))), arrays)
+        except Exception as e:
+            # unreadable file (interrupted write, layout of older code) : computed again and rewritten
+            if self.log is not None:
+                self.log.log_warning(f"Result cache : dropping {self._path(key)} ({e})")
+            return None
+
+    def _save(self, key, result):
+        try:
+            layout, arrays = _encode(result)
+            partial_path = self._path(key) + ".part"
+            with open(partial_path, "wb") as file:   # a file object : numpy adds no extension
+                np.savez_compressed(file, __layout__=np.array(json.dumps(layout)), **arrays)
+            os.replace(partial_path, self._path(key))   # readers never see a partial file
+            self._trim_disk()
+        except Exception as e:
+            if self.log is not None:
+                self.log.log_error(f"Result cache : could not write {key} ({e})")
+
+    def _trim_disk(self):
+        files = [(os.path.getmtime(path), os.path.getsize(path), path)
+                 for path in glob.glob(os.path.join(self.cache_dir, "*.npz"))]
+        used = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if used <= self.disk_budget:
+                break
+            os.remove(path)
+            used -= size
+
+
+def _encode(value, arrays=None):
+    """
+     (layout, arrays) of a result : layout is a JSON description of its structure referring to
+     the arrays by name, so it is stored without pickling.
+    """
+    arrays = {} if arrays is None else arrays
+    if isinstance(value, np.ndarray):
+        name = f"a{len(arrays)}"
+        arrays[name] = value
+        return {"array": name}, arrays
+    if isinstance(value, (tuple, list)):
+        return {"tuple" if isinstance(value, tuple) else "list": [_encode(item, arrays)[0] for item in value]}, arrays
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {"value": value}, arrays
+    if isinstance(value, np.generic):
+        return {"value": value.item()}, arrays
+    if type(value).__module__.startswith("app."):
+        fields = {name: _encode(field, arrays)[0] for name, field in vars(value).items()}
+        return {"object": f"{type(value).__module__}:{type(value).__qualname__}", "fields": fields}, arrays
+    raise TypeError(f"Cannot cache a {type(value).__name__}")
+
+
+def _decode(layout, arrays):
+    if "array" in layout:
+        return arrays[layout["array"]]
+    if "tuple" in layout:
+        return tuple(_decode(item, arrays) for item in layout["tuple"])
+    if "list" in layout:
+        return [_decode(item, arrays) for item in layout["list"]]
+    if "value" in layout:
+        return layout["value"]
+
+    module, name = layout["object"].split(":")
+    if not module.startswith("app."):
+        raise ValueError(f"Not a class of the app : {layout['object']}")
+    value = object.__new__(getattr(importlib.import_module(module), name))
+    value.__dict__.update({field: _decode(item, arrays) for field, item in layout["fields"].items()})
+    return value
@@ -1,13 +1,77 @@
 import os
 import cv2
+import numpy as np
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QFileDialog
 
 
+class GroupBoxImageView:
+    def __init__(self, groupbox):
+        """
+         Persistent image view of a group box : one QLabel and one QPixmap updated in place for every image.
+         Images are first scaled (down only) to the display size into a buffer reused while that size holds,
+         then converted to RGB in a second reused buffer, so a refresh costs display pixels, not image pixels.
+        """
+        self.groupbox = groupbox
+        self.pixmap = QtGui.QPixmap()
+        self.scaled = None   # image resized to the display size
+        self.buffer = None   # RGB (or grayscale) pixels the QImage is built on
+
+        self.label = QtWidgets.QLabel(groupbox)
+        self.label.setScaledContents(True)
+        self.label.setMinimumSize(500, 500)
+        self.label.setMaximumSize(groupbox.size())
+
+        layout = groupbox.layout()
+        if layout is None:
+            layout = QtWidgets.QVBoxLayout(groupbox)
+            groupbox.setLayout(layout)
+
+        layout.addWidget(self.label)
+        layout.setContentsMargins(0, 25, 0, 0)
+        layout.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
+        self.layout = layout
+
+    def display_size(self):
+        margins = self.layout.contentsMargins()
+        return (max(1, self.groupbox.width() - margins.left() - margins.right()),
+                max(1, self.groupbox.height() - margins.top() - margins.bottom()))
+
+    def show(self, image):
+        height, width = image.shape[:2]
+        display_width, display_height = self.display_size()
+        size = (min(width, display_width), min(height, display_height))
+        shape = (size[1], size[0]) + image.shape[2:]
+        if self.buffer is None or self.buffer.shape != shape:
+            self.scaled = np.empty(shape, dtype=np.uint8)
+            self.buffer = np.empty(shape, dtype=np.uint8)
+
+        # scale first (linear : a fixed number of source pixels per displayed pixel), convert the small image
+        source = image
+        if size != (width, height):
+            source = cv2.resize(image, size, dst=self.scaled, interpolation=cv2.INTER_LINEAR)
+
+        if len(shape) == 3:
+            cv2.cvtColor(source, cv2.COLOR_BGR2RGB, dst=self.buffer)
+            image_format = QtGui.QImage.Format.Format_RGB888
+        else:
+            np.copyto(self.buffer, source)
+            image_format = QtGui.QImage.Format.Format_Grayscale8
+
+        qimage = QtGui.QImage(self.buffer.data, size[0], size[1], self.buffer.strides[0], image_format)
+        self.pixmap.convertFromImage(qimage)   # copies the pixels, the buffer can be reused right away
+        self.label.setPixmap(self.pixmap)
+        self.label.show()
+
+    def clear(self):
+        self.label.clear()
+
+
 class ImageServices:
     def __init__(self):
         self.last_upload_folder = "static/images"
         self.last_save_folder = "/"
+        self.image_views = {}   # group box -> its GroupBoxImageView
 
     def upload_image_file(self):
         """
@@ -68,33 +132,36 @@ class ImageServices:
         if image is None:
             return
 
-        if len(image.shape) == 3:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            height, width, channels = image.shape
-            bytes_per_line = channels * width
-            qimage = QtGui.QImage(image.data, width, height, bytes_per_line, QtGui.QImage.Format.Format_RGB888)
-        else:
-            height, width = image.shape
-            bytes_per_line = width
-            qimage = QtGui.QImage(image.data, width, height, bytes_per_line, QtGui.QImage.Format.Format_Grayscale8)
-
-        pixmap = QtGui.QPixmap.fromImage(qimage)
-        label = QtWidgets.QLabel(groupbox)
-        label.setPixmap(pixmap)
-        label.setScaledContents(True)
-        label.setMinimumSize(500, 500)
-        label.setMaximumSize(groupbox.size())
+        self.__image_view(groupbox).show(image)
 
-        layout = groupbox.layout()
-        if layout is None:
-            layout = QtWidgets.QVBoxLayout(groupbox)
-            groupbox.setLayout(layout)
+    def display_proxy(self, groupbox, image):
+        """
+         Copy of image fitting the display of groupbox (aspect ratio kept, INTER_AREA) and its scale (<= 1) :
+         interactive previews run on it, the full resolution image is only processed on demand.
+        """
+        width, height = self.__image_view(groupbox).display_size()
+        scale = min(1.0, width / image.shape[1], height / image.shape[0])
+        if scale >= 1:
+            return image, 1.0
+        size = (max(1, int(round(image.shape[1] * scale))), max(1, int(round(image.shape[0] * scale))))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
 
-        layout.addWidget(label)
-        layout.setContentsMargins(0, 25, 0, 0)
-        layout.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
+    def __image_view(self, groupbox):
+        view = self.image_views.get(groupbox)
+        if view is None:
+            # first use of this group box : its placeholder widgets make room for a persistent view
+            layout = groupbox.layout()
+            if layout:
+                self.__clear_layout(layout)
+            view = self.image_views[groupbox] = GroupBoxImageView(groupbox)
+        return view
 
     def clear_image(self, groupbox):
+        view = self.image_views.get(groupbox)
+        if view is not None:
+            view.clear()
+            return
+
         layout = groupbox.layout()
         if layout:
             self.__clear_layout(layout)
@@ -0,0 +1,139 @@
+import traceback
+from functools import partial
+
+from PyQt5 import QtCore
+
+from app.utils.cancellation import CancellationToken, JobCancelled
+
+
+class JobSignals(QtCore.QObject):
+    """Signals of one job, emitted from the worker thread and delivered (queued) in the GUI thread."""
+    progress = QtCore.pyqtSignal(int, float)      # job id, fraction done
+    preview = QtCore.pyqtSignal(int, object)      # job id, intermediate result
+    finished = QtCore.pyqtSignal(int, object)     # job id, result
+    failed = QtCore.pyqtSignal(int, str)          # job id, error message
+    cancelled = QtCore.pyqtSignal(int)            # job id
+
+
+class Job(QtCore.QRunnable):
+    def __init__(self, job_id, function, args, kwargs):
+        """Runs function(*args, token=..., **kwargs) on a pool thread, the token is checked by its loops."""
+        super().__init__()
+        self.job_id = job_id
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = JobSignals()
+        self.token = CancellationToken(progress=partial(self.signals.progress.emit, job_id),
+                                       preview=partial(self.signals.preview.emit, job_id))
+
+    def run(self):
+        # superseded before it even started
+        if self.token.cancelled:
+            self.signals.cancelled.emit(self.job_id)
+            return
+
+        try:
+            result = self.function(*self.args, token=self.token, **self.kwargs)
+        except JobCancelled:
+            self.signals.cancelled.emit(self.job_id)
+        except Exception as e:
+            traceback.print_exc()
+            self.signals.failed.emit(self.job_id, str(e))
+        else:
+            if self.token.cancelled:
+                self.signals.cancelled.emit(self.job_id)
+            else:
+                self.signals.finished.emit(self.job_id, result)
+
+
+class JobService(QtCore.QObject):
+    """
+     Background execution of the processing functions, one current job per view (e.g. "processed") :
+     submitting a job cancels the previous one of its view, and a result arriving from a job that is no longer
+     the current one of its view is dropped. Jobs run one at a time by default (max_threads) : processing objects
+     shared by the jobs (caches, per run statistics) are never used by two threads at once, and a cancelled job
+     stops at its next checkpoint before the following one starts.
+    """
+    progress = QtCore.pyqtSignal(str, float)   # view, fraction done of its current job
+    busy_changed = QtCore.pyqtSignal(str, bool)   # view, a job of the view is running or waiting
+
+    def __init__(self, max_threads=1):
+        super().__init__()
+        self.pool = QtCore.QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+        self._current = {}   # view -> current job
+        self._running = {}   # job id -> job (keeps its signals object alive until it ends)
+        self._next_id = 0
+
+    def submit(self, view, function, *args, on_result=None, on_error=None, on_preview=None, **kwargs):
+        """
+         Runs function(*args, token=token, **kwargs) in the background as the current job of view.
+         on_result(result) / on_error(message) / on_preview(intermediate result) are called in the GUI thread,
+         only if the job is still current. Without on_preview the job computes no intermediate results.
+         Returns the job id.
+        """
+        self.cancel(view)
+        self._next_id += 1
+        job = Job(self._next_id, function, args, kwargs)
+        job.setAutoDelete(False)
+        job.signals.progress.connect(partial(self._on_progress, view))
+        if on_preview is None:
+            job.token.preview = None
+        else:
+            job.signals.preview.connect(partial(self._on_preview, view, on_preview))
+        job.signals.finished.connect(partial(self._on_finished, view, on_result))
+        job.signals.failed.connect(partial(self._on_failed, view, on_error))
+        job.signals.cancelled.connect(partial(self._on_cancelled, view))
+
+        self._current[view] = job
+        self._running[job.job_id] = job
+        self.busy_changed.emit(view, True)
+        self.pool.start(job)
+        return job.job_id
+
+    def cancel(self, view=None):
+        """Cancels the current job of view (of every view if None), its result will be dropped."""
+        views = list(self._current) if view is None else [view]
+        for name in views:
+            job = self._current.pop(name, None)
+            if job is not None:
+                job.token.cancel()
+                self.busy_changed.emit(name, False)
+
+    def is_busy(self, view):
+        return view in self._current
+
+    def _is_current(self, view, job_id):
+        job = self._current.get(view)
+        return job is not None and job.job_id == job_id
+
+    def _on_progress(self, view, job_id, fraction):
+        if self._is_current(view, job_id):
+            self.progress.emit(view, fraction)
+
+    def _on_preview(self, view, on_preview, job_id, result):
+        if self._is_current(view, job_id):
+            on_preview(result)
+
+    def _on_finished(self, view, on_result, job_id, result):
+        current = self._end(view, job_id)
+        if current and on_result is not None:
+            on_result(result)
+
+    def _on_failed(self, view, on_error, job_id, message):
+        current = self._end(view, job_id)
+        if current and on_error is not None:
+            on_error(message)
+
+    def _on_cancelled(self, view, job_id):
+        self._end(view, job_id)
+
+    def _end(self, view, job_id):
+        # forget the job, returns whether it was still the current one of its view (else its outcome is stale)
+        self._running.pop(job_id, None)
+        if not self._is_current(view, job_id):
+            return False
+        del self._current[view]
+        self.busy_changed.emit(view, False)
+        return True
@@ -0,0 +1,66 @@
+import threading
+import time
+
+
+class JobCancelled(Exception):
+    """Raised at a checkpoint of a processing function whose job was cancelled."""
+
+
+class CancellationToken:
+    def __init__(self, progress=None, preview=None, preview_interval=0.1):
+        """
+         Cooperative cancellation of a processing job : the GUI thread calls cancel(), the processing function
+         calls checkpoint(token, ...) in its loops and stops there with JobCancelled.
+         progress : optional callback receiving the fraction done (0 - 1) reported at the checkpoints.
+         preview  : optional callback receiving intermediate results, at most once every preview_interval seconds
+                    (passed through render first when set, e.g. to colourize a label map)
+        """
+        self._event = threading.Event()
+        self.progress = progress
+        self.preview = preview
+        self.preview_interval = preview_interval
+        self.render = None
+        self._last_preview = None
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise JobCancelled()
+
+    def report(self, fraction):
+        self.check()
+        if self.progress is not None:
+            self.progress(min(max(float(fraction), 0.0), 1.0))
+
+    def wants_preview(self):
+        return self.preview is not None and (self._last_preview is None
+                                             or time.perf_counter() - self._last_preview >= self.preview_interval)
+
+    def show_preview(self, make_preview):
+        # make_preview is only called when a preview is due : intermediate results cost nothing otherwise
+        if not self.wants_preview():
+            return
+        self._last_preview = time.perf_counter()
+        result = make_preview()
+        self.preview(result if self.render is None else self.render(result))
+
+
+def checkpoint(token, fraction=None, preview=None):
+    """
+     Cancellation point of a processing loop (no-op without token), optionally reporting the fraction done
+     and an intermediate result : preview is a function returning it, called only when the token wants one.
+    """
+    if token is None:
+        return
+    if fraction is None:
+        token.check()
+    else:
+        token.report(fraction)
+    if preview is not None:
+        token.show_preview(preview)
@@ -11,6 +11,7 @@ class LoggingManager:
 
         log_path = os.path.join(log_directory, log_file)
         self.log_file = log_path
+        self.counters = {}   # named event counts (e.g. result cache hits / misses), see count
 
         logging.basicConfig(
             filename=self.log_file,
@@ -27,6 +28,14 @@ class LoggingManager:
             'debug': logging.debug
         }[level](message)
 
+    def count(self, counter, message=None):
+        """Increments the named counter, logging message (if any) with the current counts."""
+        self.counters[counter] = self.counters.get(counter, 0) + 1
+        if message is not None:
+            counts = ", ".join(f"{name}={value}" for name, value in sorted(self.counters.items()))
+            logging.info(f"{message} [{counts}]")
+        return self.counters[counter]
+
     def log_action(self, message):
         logging.info(message)
 
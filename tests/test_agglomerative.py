@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from app.processing.segmentation_clusters import _centroid_linkage, agglomerative_tree
+
+
+def _brute_force_linkage(points, weights):
+    """Closest pair of all the clusters merged one at a time, ties to the lowest (kept, merged) (reference)."""
+    centroids = {i: point.astype(np.float64) for i, point in enumerate(points)}
+    sizes = {i: float(weight) for i, weight in enumerate(weights)}
+    merges = []
+    while len(centroids) > 1:
+        ids = sorted(centroids)
+        stacked = np.array([centroids[i] for i in ids])
+        dist = ((stacked[:, None, :] - stacked[None, :, :]) ** 2).sum(axis=2)
+        np.fill_diagonal(dist, np.inf)
+        first, second = np.unravel_index(np.argmin(dist), dist.shape)
+        kept, merged = ids[first], ids[second]
+        total = sizes[kept] + sizes[merged]
+        centroids[kept] = (centroids[kept] * sizes[kept] + centroids[merged] * sizes[merged]) / total
+        sizes[kept] = total
+        del centroids[merged], sizes[merged]
+        merges.append((kept, merged, np.sqrt(dist[first, second])))
+    return np.array(merges).reshape(-1, 3)
+
+
+def _point_sets():
+    rng = np.random.default_rng(0)
+    clumped = np.concatenate([rng.integers(0, 12, (150, 3)), rng.integers(0, 256, (40, 3))])
+    return {
+        "float_colour": rng.random((180, 3)) * 255,
+        "float_gray": rng.random((120, 1)) * 255,
+        "float_cluster": np.concatenate([rng.random((120, 3)) * 255, rng.random((30, 3)) * 5 + 200]),
+        "integer_clumped": np.unique(clumped, axis=0).astype(np.float64),
+    }
+
+
+@pytest.mark.parametrize("dense_below", [0, 16, 4096], ids=["sweep", "sweep_then_dense", "dense"])
+@pytest.mark.parametrize("name", list(_point_sets()))
+def test_centroid_linkage_matches_brute_force(name, dense_below):
+    points = _point_sets()[name]
+    weights = np.random.default_rng(1).integers(1, 50, len(points)).astype(np.float64)
+    expected = _brute_force_linkage(points, weights)
+
+    merges = np.array(_centroid_linkage(points, weights, dense_below=dense_below))
+
+    np.testing.assert_array_equal(merges[:, :2], expected[:, :2])
+    np.testing.assert_allclose(merges[:, 2], expected[:, 2])
+
+
+def test_agglomerative_tree_cut_groups_colours():
+    image = np.zeros((8, 12, 3), dtype=np.uint8)
+    image[:, 4:8] = (0, 0, 250)
+    image[:, 8:] = (0, 250, 0)
+    image[0, 0] = (3, 0, 0)
+
+    labels = agglomerative_tree(image, size=None).cut(3)
+
+    assert len(np.unique(labels)) == 3
+    for columns in (slice(0, 4), slice(4, 8), slice(8, 12)):
+        assert len(np.unique(labels[:, columns])) == 1
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from app.processing.segmentation_clusters import kMeans_segmentation
+
+
+@pytest.mark.parametrize("init", ["k-means++", "histogram", "random"])
+def test_histogram_kmeans_with_more_clusters_than_colours(init):
+    image = np.zeros((10, 10, 3), dtype=np.uint8)
+    image[:, 5:] = 200
+
+    labels = kMeans_segmentation(image, 5, init=init, colour_histogram=True)
+
+    assert labels.shape == (10, 10)
+    assert len(np.unique(labels[:, :5])) == 1 and len(np.unique(labels[:, 5:])) == 1
+    assert labels[0, 0] != labels[0, 9]
+
+
+def test_histogram_kmeans_single_colour():
+    labels = kMeans_segmentation(np.full((4, 6, 3), 7, dtype=np.uint8), 3, colour_histogram=True)
+    assert np.all(labels == labels[0, 0])
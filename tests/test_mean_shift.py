@@ -0,0 +1,43 @@
+import numpy as np
+import cv2
+
+from app.processing.segmentation import ImageSegmenter
+
+
+def test_group_modes_merges_modes_within_window():
+    segmenter = ImageSegmenter()   # bandwidth 30
+    modes = np.array([[100, 100, 100, 10, 10],
+                      [120, 100, 100, 20, 10],    # within bandwidth and radius of the first
+                      [200, 100, 100, 10, 10],    # other colour
+                      [100, 100, 100, 10, 40]])   # other place
+    modes, group = segmenter._group_modes(modes.astype(np.float64), np.array([3.0, 1.0, 1.0, 1.0]), 15)
+
+    assert len(modes) == 3
+    assert group[0] == group[1] and len({group[0], group[2], group[3]}) == 3
+    np.testing.assert_allclose(modes[group[0]], [105, 100, 100, 12.5, 10])
+
+
+def test_group_modes_does_not_chain_a_gradient():
+    segmenter = ImageSegmenter()
+    # every mode within bandwidth of the next one, the ends far apart
+    modes = np.array([[lightness, 100, 100, 10, 10] for lightness in range(0, 250, 20)], dtype=np.float64)
+    modes, group = segmenter._group_modes(modes, np.ones(len(modes)), 15)
+
+    assert len(modes) > 1
+    for index in np.unique(group):
+        members = np.flatnonzero(group == index)
+        assert members.max() - members.min() <= 3   # 60 apart at most : within bandwidth of a common mode
+
+
+def test_mean_shift_segments_flat_regions():
+    image = np.zeros((60, 80, 3), dtype=np.uint8)
+    image[:, 40:] = (0, 0, 200)
+    image = cv2.GaussianBlur(image, (3, 3), 0) + np.random.default_rng(0).integers(0, 3, image.shape, dtype=np.uint8)
+    segmenter = ImageSegmenter()
+
+    result = segmenter.mean_shift_segments(image)
+
+    left, right = np.unique(result.labels[:, :35]), np.unique(result.labels[:, 45:])
+    assert len(left) == 1 and len(right) == 1 and left[0] != right[0]
+    assert result.trajectories == segmenter.mean_shift_trajectories > 0
+    assert result.short_circuited == segmenter.short_circuited_trajectories
@@ -0,0 +1,123 @@
+import numpy as np
+import cv2
+import pytest
+
+from app.processing.segmentation import ImageSegmenter
+
+TOLERANCES = [0, 3, 10, 25, 60, 128, 255]
+
+
+def _images():
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (48, 64), dtype=np.uint8)
+    return {
+        "random": noise,
+        "blurred": cv2.GaussianBlur(noise, (9, 9), 3),
+        "bgr": cv2.GaussianBlur(rng.integers(0, 256, (40, 56, 3), dtype=np.uint8), (7, 7), 2),
+    }
+
+
+def _bfs(image, seed, tolerance):
+    reference = ImageSegmenter()
+    reference.set_seed_point(seed)
+    reference.set_tolerance(tolerance)
+    return reference.region_growing_bfs(image)
+
+
+@pytest.fixture(params=list(_images().items()), ids=lambda item: item[0])
+def image(request):
+    return request.param[1]
+
+
+@pytest.mark.parametrize("seed", [(0, 0), (20, 30), (39, 55)])
+def test_region_growing_matches_bfs(image, seed):
+    segmenter = ImageSegmenter()
+    segmenter.set_seed_point(seed)
+
+    # ascending then descending : later fills reuse the cached state of the earlier ones
+    for tolerance in TOLERANCES + TOLERANCES[::-1]:
+        segmenter.set_tolerance(tolerance)
+        np.testing.assert_array_equal(segmenter.region_growing(image), _bfs(image, seed, tolerance),
+                                      err_msg=f"tolerance {tolerance}")
+
+
+@pytest.mark.parametrize("max_tolerance", [40, 255])
+def test_tolerance_distance_map_matches_bfs(image, max_tolerance):
+    seed = (20, 30)
+    distance = ImageSegmenter().tolerance_distance_map(image, seed, max_tolerance=max_tolerance)
+
+    for tolerance in TOLERANCES:
+        if tolerance > max_tolerance:
+            continue
+        expected = _bfs(image, seed, tolerance) > 0
+        np.testing.assert_array_equal(distance <= tolerance, expected, err_msg=f"tolerance {tolerance}")
+
+
+def test_region_growing_after_distance_map_matches_bfs(image):
+    seed = (10, 12)
+    segmenter = ImageSegmenter()
+    segmenter.tolerance_distance_map(image, seed, max_tolerance=100)
+
+    for tolerance in TOLERANCES:
+        np.testing.assert_array_equal(segmenter.region_growing(image, seed, tolerance), _bfs(image, seed, tolerance),
+                                      err_msg=f"tolerance {tolerance}")
+
+
+POLICIES = ["first_come", "closest"]
+
+
+@pytest.mark.parametrize("policy", POLICIES)
+@pytest.mark.parametrize("seed", [(0, 0), (20, 30)])
+def test_region_growing_multi_single_seed_matches_bfs(image, seed, policy):
+    for tolerance in TOLERANCES:
+        labels = ImageSegmenter().region_growing_multi(image, [seed], policy, tolerance=tolerance)
+        np.testing.assert_array_equal(labels == 1, _bfs(image, seed, tolerance) > 0, err_msg=f"tolerance {tolerance}")
+        assert set(np.unique(labels)) <= {0, 1}
+
+
+@pytest.mark.parametrize("policy", POLICIES)
+def test_region_growing_multi_duplicate_seed_stays_empty(image, policy):
+    seed = (20, 30)
+    labels = ImageSegmenter().region_growing_multi(image, [seed, seed], policy, tolerance=25)
+    np.testing.assert_array_equal(labels, (_bfs(image, seed, 25) > 0).astype(np.int32))
+
+    labels = ImageSegmenter().region_growing_multi(image, [seed, (5, 5), seed], policy, tolerance=25)
+    assert labels[seed] == 1 and labels[5, 5] == 2
+    assert set(np.unique(labels)) <= {0, 1, 2}
+
+
+@pytest.mark.parametrize("policy", POLICIES)
+@pytest.mark.parametrize("tolerance", [10, 25, 60])
+def test_region_growing_multi_regions_stay_inside_their_seed_bfs(image, policy, tolerance):
+    seeds = [(5, 5), (20, 30), (39, 55), (21, 31), (30, 8)]
+    labels = ImageSegmenter().region_growing_multi(image, seeds, policy, tolerance=tolerance)
+
+    reachable = np.zeros(labels.shape, dtype=bool)
+    for label, seed in enumerate(seeds, start=1):
+        region = _bfs(image, seed, tolerance) > 0
+        assert labels[seed] == label
+        assert not np.any((labels == label) & ~region), f"seed {seed}"
+        reachable |= region
+    # a pixel no seed reaches stays background
+    assert not np.any((labels > 0) & ~reachable)
+
+
+def test_region_growing_multi_collisions():
+    closer_to_left = np.array([[100, 104, 104, 104, 110]], dtype=np.uint8)
+    segmenter = ImageSegmenter()
+
+    # first come : each wavefront takes its side, the pixel reached by both at once goes to the lower seed index
+    np.testing.assert_array_equal(
+        segmenter.region_growing_multi(closer_to_left, [(0, 0), (0, 4)], "first_come", tolerance=20), [[1, 1, 1, 2, 2]])
+    np.testing.assert_array_equal(
+        segmenter.region_growing_multi(closer_to_left, [(0, 4), (0, 0)], "first_come", tolerance=20), [[2, 2, 1, 1, 1]])
+    # closest : the seed with the closest intensity takes every pixel it reaches first
+    np.testing.assert_array_equal(
+        segmenter.region_growing_multi(closer_to_left, [(0, 0), (0, 4)], "closest", tolerance=20), [[1, 1, 1, 1, 2]])
+
+    # same difference to both seeds : tie -> lower seed index
+    halfway = np.array([[100, 105, 105, 105, 110]], dtype=np.uint8)
+    np.testing.assert_array_equal(
+        segmenter.region_growing_multi(halfway, [(0, 0), (0, 4)], "closest", tolerance=20), [[1, 1, 1, 2, 2]])
+    np.testing.assert_array_equal(
+        segmenter.region_growing_multi(halfway, [(0, 4), (0, 0)], "closest", tolerance=20), [[2, 2, 1, 1, 1]])
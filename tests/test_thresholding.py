@@ -0,0 +1,197 @@
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from app.processing.thresholding import Thresholding
+
+
+def _mask_optimal_thresholding(block):
+    """The mask based iterative selection optimal_thresholding replaced (reference)."""
+    height, width = block.shape
+    output_block = block.copy()
+
+    bg_mask = np.zeros_like(block, dtype=bool)
+    bg_mask[0, 0] = True
+    bg_mask[height - 1, 0] = True
+    bg_mask[0, width - 1] = True
+    bg_mask[height - 1, width - 1] = True
+    obj_mask = ~bg_mask
+
+    new_threshold = 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for i in range(20):
+            previous_threshold = new_threshold
+            obj_mean = np.mean(output_block[obj_mask]) if obj_mask.any() else np.nan
+            bg_mean = np.mean(output_block[bg_mask]) if bg_mask.any() else np.nan
+            new_threshold = (obj_mean + bg_mean) / 2
+            obj_mask = output_block > new_threshold
+            bg_mask = output_block <= new_threshold
+            if np.abs(previous_threshold - new_threshold) < 2:
+                break
+
+    output_block[block >= new_threshold] = 255
+    output_block[block < new_threshold] = 0
+    return output_block
+
+
+def _per_block_thresholding(image, thresholding_method, block_size):
+    """The per block loop batched_local_thresholding replaced (reference)."""
+    height, width = image.shape
+    output_image = np.zeros_like(image, dtype=np.uint8)
+    for i in range(0, height, block_size):
+        for j in range(0, width, block_size):
+            window = image[i:min(i + block_size, height), j:min(j + block_size, width)]
+            output_image[i:min(i + block_size, height), j:min(j + block_size, width)] = thresholding_method(window)
+    return output_image
+
+
+def _blocks():
+    rng = np.random.default_rng(0)
+    blocks = {
+        "uniform": np.full((12, 9), 77, dtype=np.uint8),
+        "two_valued": np.where(rng.random((15, 15)) < 0.3, 40, 200).astype(np.uint8),
+        "two_valued_corners": np.pad(np.full((6, 6), 10, dtype=np.uint8), 2, constant_values=250),
+        "single_pixel": np.array([[123]], dtype=np.uint8),
+        "row": rng.integers(0, 256, (1, 17), dtype=np.uint8),
+        "column": rng.integers(0, 256, (23, 1), dtype=np.uint8),
+        "two_pixels": np.array([[0, 255]], dtype=np.uint8),
+        "dark_corners": np.pad(rng.integers(100, 256, (20, 26), dtype=np.uint8), 1),
+    }
+    for i in range(40):
+        height, width = rng.integers(1, 40, 2)
+        low, high = np.sort(rng.integers(0, 257, 2))
+        blocks[f"random_{i}"] = rng.integers(low, max(high, low + 1), (height, width)).astype(np.uint8)
+    return blocks
+
+
+@pytest.mark.parametrize("block", list(_blocks().values()), ids=list(_blocks()))
+def test_optimal_thresholding_matches_mask_loop(block):
+    np.testing.assert_array_equal(Thresholding.optimal_thresholding(block), _mask_optimal_thresholding(block))
+
+
+def _loop_otsu_threshold(histogram):
+    """The 256 step loop otsu_threshold replaced (reference)."""
+    variances = np.zeros(256)
+    total_pixels = np.sum(histogram)
+    for i in range(0, 256):
+        obj_intensities = np.sum(histogram[i:256])
+        bg_intensities = np.sum(histogram[0:i])
+        obj_mean = np.sum(np.arange(i, 256) * histogram[i:256]) / obj_intensities if obj_intensities != 0 else 0
+        bg_mean = np.sum(np.arange(0, i) * histogram[0:i]) / bg_intensities if bg_intensities != 0 else 0
+        variances[i] = (obj_intensities / total_pixels) * (bg_intensities / total_pixels) * (obj_mean - bg_mean) ** 2
+    return np.argmax(variances)
+
+
+def _histogram(block):
+    return np.histogram(block, bins=256, range=(0, 256))[0]
+
+
+@pytest.mark.parametrize("block", list(_blocks().values()), ids=list(_blocks()))
+def test_otsu_threshold_matches_loop(block):
+    assert Thresholding.otsu_threshold(_histogram(block)) == _loop_otsu_threshold(_histogram(block))
+
+
+def test_otsu_threshold_of_stacked_histograms():
+    histograms = np.array([_histogram(block) for block in _blocks().values()])
+    np.testing.assert_array_equal(Thresholding.otsu_threshold(histograms),
+                                  [_loop_otsu_threshold(histogram) for histogram in histograms])
+
+
+def _between_class_score(histogram, thresholds):
+    """Sum over the classes split at thresholds of (intensity sum)^2 / pixel count (empty classes count 0)."""
+    edges = [0, *thresholds, 256]
+    score = 0.0
+    for low, high in zip(edges[:-1], edges[1:]):
+        count = histogram[low:high].sum()
+        if count:
+            score += (np.arange(low, high) * histogram[low:high]).sum() ** 2 / count
+    return score
+
+
+@pytest.mark.parametrize("classes", [2, 3, 4])
+@pytest.mark.parametrize("seed", range(4))
+def test_multi_otsu_thresholds_match_brute_force(classes, seed):
+    rng = np.random.default_rng(seed)
+    # few intensities so every split can be tried : thresholds above the brightest pixel + 1 only add empty classes
+    brightest = 24
+    image = rng.integers(0, brightest, (30, 30)) * rng.integers(0, 2, (30, 30))
+    histogram = _histogram(image)
+
+    thresholds = Thresholding.multi_otsu_thresholds(image.astype(np.uint8), classes)
+
+    assert len(thresholds) == classes - 1 and thresholds == sorted(set(thresholds)) and 0 < thresholds[0]
+    best = max(_between_class_score(histogram, split) for split in combinations(range(1, brightest + 2), classes - 1))
+    assert _between_class_score(histogram, thresholds) == pytest.approx(best, rel=1e-12)
+
+
+def _images():
+    rng = np.random.default_rng(1)
+    noise = rng.integers(0, 256, (41, 53), dtype=np.uint8)
+    gradient = np.add.outer(np.arange(45), np.arange(58)).astype(np.uint8)
+    flat = np.full((40, 50), 90, dtype=np.uint8)
+    flat[10:30, 20:45] = 180
+    return {"noise": noise, "gradient": gradient, "flat": flat}
+
+
+@pytest.mark.parametrize("method", [Thresholding.otsu_thresholding, Thresholding.optimal_thresholding],
+                         ids=["otsu", "optimal"])
+@pytest.mark.parametrize("block_size", [1, 2, 7, 16, 30, 200])
+@pytest.mark.parametrize("name", list(_images()))
+def test_batched_local_thresholding_matches_per_block_loop(name, block_size, method):
+    image = _images()[name]
+    expected = _per_block_thresholding(image, method, block_size)
+
+    np.testing.assert_array_equal(Thresholding.local_thresholding(image, method, block_size), expected)
+    # several bands of block rows
+    np.testing.assert_array_equal(
+        Thresholding.batched_local_thresholding(image, method, block_size, band_bins=4 * 256), expected)
+
+
+def test_filter_peaks_only_kept_peaks_suppress():
+    histogram = np.zeros(256)
+    histogram[[20, 28, 36]] = [10, 9, 8]
+
+    peaks = Thresholding.filter_peaks(histogram, np.array([20, 28, 36]), min_distance=10)
+
+    np.testing.assert_array_equal(peaks, [20, 36])
+
+
+def test_filter_peaks_equal_heights_keep_rightmost():
+    histogram = np.zeros(256)
+    histogram[[50, 55]] = 5
+
+    np.testing.assert_array_equal(Thresholding.filter_peaks(histogram, np.array([50, 55]), min_distance=10), [55])
+
+
+def _window_thresholding(image, window_size, method, k, offset=0, dynamic_range=128):
+    """Per pixel window statistics computed directly (reference for adaptive_thresholding)."""
+    radius = window_size // 2
+    output = np.zeros_like(image)
+    for y in range(image.shape[0]):
+        for x in range(image.shape[1]):
+            window = image[max(y - radius, 0):y + radius + 1, max(x - radius, 0):x + radius + 1].astype(np.float64)
+            mean, deviation = window.mean(), window.std()
+            if method == "mean":
+                threshold = mean - offset
+            elif method == "niblack":
+                threshold = mean + k * deviation
+            else:
+                threshold = mean * (1 + k * (deviation / dynamic_range - 1))
+            output[y, x] = 255 if image[y, x] > threshold else 0
+    return output
+
+
+@pytest.mark.parametrize("method, k", [("mean", None), ("niblack", -0.2), ("sauvola", 0.2)])
+@pytest.mark.parametrize("window_size", [3, 9, 31])
+def test_adaptive_thresholding_matches_window_statistics(method, k, window_size):
+    image = _images()["noise"][:20, :25]
+    expected = _window_thresholding(image, window_size, method, k)
+    np.testing.assert_array_equal(Thresholding.adaptive_thresholding(image, window_size, method), expected)
+
+
+@pytest.mark.parametrize("method", Thresholding.ADAPTIVE_METHODS)
+def test_local_thresholding_dispatches_window_methods(method):
+    image = _images()["gradient"]
+    np.testing.assert_array_equal(Thresholding.local_thresholding(image, method, 10),
+                                  Thresholding.adaptive_thresholding(image, 11, method))